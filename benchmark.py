@@ -0,0 +1,1968 @@
+"""
+ローカルのスタンドイン HTTP サーバーを使ったベンチマーク。
+
+使い方:
+    python benchmark.py              # 一覧を表示
+    python benchmark.py exif-fetch   # 指定したベンチマークを実行
+    python benchmark.py pipeline small medium
+                                     # 合成ブログで全工程を測り benchmarks/results.jsonl に記録（コミットしない）
+"""
+import io
+import os
+import re
+import sys
+import json
+import base64
+import random
+import platform
+import glob
+import time
+import shutil
+import subprocess
+import mimetypes
+import unicodedata
+import tempfile
+import threading
+import contextlib
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+from html.parser import HTMLParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import piexif
+import requests
+from bs4 import BeautifulSoup
+
+# main.py は import 時に環境変数を要求するのでダミーを入れておく
+os.environ.setdefault("HATENA_USER", "bench")
+os.environ.setdefault("HATENA_BLOG_ID", "bench.example.com")
+os.environ.setdefault("HATENA_API_KEY", "bench")
+
+import main  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_JPEG = os.path.join(REPO_DIR, "exif-test.jpg")
+
+
+# ===========================
+# スタンドイン HTTP サーバー
+# ===========================
+class StandInServer:
+    """routes（path → bytes）を配信するだけのローカルサーバー。
+
+    latency 秒の遅延を挟んでネットワーク待ちを再現し、
+    path ごとのリクエスト数と送信バイト数を記録する。
+    honor_range=False にすると Range ヘッダーを無視するサーバーを再現する。
+    content_type=None なら拡張子から Content-Type を決める（ページ配信用）。
+    """
+
+    def __init__(self, routes, latency=0.0, honor_range=True, content_type="image/jpeg"):
+        self.routes = routes
+        self.latency = latency
+        self.honor_range = honor_range
+        self.content_type = content_type
+        self.requests = {}
+        self.bytes_sent = {}
+        self.connections = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # keep-alive 時の遅延 ACK 待ちを避ける
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                body = server.routes.get(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    server._count(self.path, 0)
+                    return
+                status = 200
+                total = len(body)
+                m = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if m and server.honor_range:
+                    start = int(m.group(1))
+                    if start >= total:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{total}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    end = min(int(m.group(2)) if m.group(2) else total - 1, total - 1)
+                    body = body[start:end + 1]
+                    status = 206
+
+                self.send_response(status)
+                self.send_header(
+                    "Content-Type",
+                    server.content_type or mimetypes.guess_type(self.path)[0] or "application/octet-stream",
+                )
+                self.send_header("Content-Length", str(len(body)))
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    return  # クライアントがタイムアウトで先に切った
+                server._count(self.path, len(body))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def _count(self, path, n):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.bytes_sent[path] = self.bytes_sent.get(path, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent.clear()
+            self.connections = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ===========================
+# ソケットを使わない偽 transport
+# ===========================
+class FakeTransport(requests.adapters.BaseAdapter):
+    """main.create_http_session(adapter=...) に差し込む偽 transport。
+
+    responses は url → [(status, body, headers), ...]。呼ばれるたびに先頭から
+    消費し、最後の 1 件は以降ずっと返し続ける。
+    """
+
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = {url: list(seq) for url, seq in responses.items()}
+        self.calls = []
+
+    def send(self, request, **kwargs):
+        self.calls.append(request.url)
+        queue = self.responses.get(request.url) or [(404, b"", {})]
+        status, body, headers = queue.pop(0) if len(queue) > 1 else queue[0]
+
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = body
+        resp.headers.update(headers)
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def _without_checked(records):
+    """取得時刻を除いたレコード（実行ごとに変わるので比較から外す）"""
+    return {src: {k: v for k, v in r.items() if k != "checked"} for src, r in records.items()}
+
+
+def _quiet(func, *args, **kwargs):
+    """main.py の進捗 print を黙らせて実行する"""
+    devnull = open(os.devnull, "w", encoding="utf-8")
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+
+@contextlib.contextmanager
+def _workdir():
+    """cache/ や output/ を汚さないよう一時ディレクトリで実行する"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+# ===========================
+# build_image_records の並列数スケーリング（EXIF のみ）
+# ===========================
+def bench_exif_fetch(n_images=64, latency=0.05, worker_counts=(1, 2, 4, 8, 16)):
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+
+    routes = {f"/img/{i:05d}.jpg": jpeg for i in range(n_images)}
+    with StandInServer(routes, latency=latency) as server, _workdir():
+        entries = [{"alt": "bench", "src": server.base_url + p} for p in routes]
+
+        # レート制限はスケーリング計測の邪魔になるので外す
+        main.EXIF_HOST_RATE = 0
+        main.THUMB_WIDTHS = ()
+
+        print(f"📊 {n_images} 枚 / 遅延 {latency * 1000:.0f}ms / 画像 {len(jpeg):,} bytes")
+        baseline = None
+        for workers in worker_counts:
+            t0 = time.perf_counter()
+            cache = main.exif_view(_quiet(main.build_image_records, entries, {}, workers=workers))
+            elapsed = time.perf_counter() - t0
+
+            # 逐次版（workers=1）とキャッシュ内容・並びが一致すること
+            snapshot = list(cache.items())
+            if baseline is None:
+                baseline = snapshot
+            elif snapshot != baseline:
+                raise AssertionError(f"workers={workers} の結果が逐次版と一致しません")
+
+            print(f"  workers={workers:>2}: {elapsed:6.2f}s  {n_images / elapsed:7.1f} img/s")
+
+
+# ===========================
+# Range 取得で転送されるバイト数
+# ===========================
+def bench_range_fetch(n_images=8):
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+
+    state, (_, app1_end) = main._locate_exif_segment(jpeg)
+    assert state == "found"
+
+    routes = {f"/img/{i:05d}.jpg": jpeg for i in range(n_images)}
+    expected = main.extract_exif_from_bytes(jpeg)
+    assert expected
+    main.EXIF_HOST_RATE = 0
+    main.THUMB_WIDTHS = ()
+
+    cases = [
+        # (説明, EXIF_FETCH_MODE, 初期ウィンドウ, Range対応, 1枚あたりの期待転送量)
+        ("全体取得", "full", main.EXIF_RANGE_BYTES, True, len(jpeg)),
+        ("Range 64KB", "range", 65536, True, 65536),
+        ("Range 16KB→拡張", "range", 16384, True, app1_end),
+        ("Range 無視サーバー", "range", 65536, False, len(jpeg)),
+    ]
+
+    print(f"📊 {os.path.basename(SAMPLE_JPEG)}: {len(jpeg):,} bytes / APP1 終端 {app1_end:,} bytes")
+    for label, mode, window, honor, per_image in cases:
+        main.EXIF_FETCH_MODE = mode
+        main.EXIF_RANGE_BYTES = window
+        with StandInServer(routes, honor_range=honor) as server, _workdir():
+            entries = [{"alt": "bench", "src": server.base_url + p} for p in routes]
+            cache = main.exif_view(_quiet(main.build_image_records, entries, {}, workers=4))
+
+            # EXIF の中身は全体取得と同じであること
+            if any(v != expected for v in cache.values()):
+                raise AssertionError(f"{label}: EXIF が全体取得の結果と一致しません")
+
+            for path in routes:
+                sent = server.bytes_sent.get(path, 0)
+                if sent != per_image:
+                    raise AssertionError(f"{label}: {path} の転送量 {sent} != 期待値 {per_image}")
+
+            reqs = sum(server.requests.values()) / n_images
+            print(f"  {label:<16} {per_image:>10,} bytes/枚  {reqs:.0f} req/枚  ✅")
+
+
+# ===========================
+# 共有セッション（keep-alive / リトライ）
+# ===========================
+def bench_http_session(n_requests=200):
+    routes = {f"/page/{i}": b"x" * 2048 for i in range(n_requests)}
+    urls = list(routes)
+
+    with StandInServer(routes) as server:
+        t0 = time.perf_counter()
+        for p in urls:
+            requests.get(server.base_url + p, timeout=10)
+        bare = time.perf_counter() - t0
+        bare_conns = server.connections
+
+        server.reset()
+        main.set_http_session(main.create_http_session())
+        t0 = time.perf_counter()
+        for p in urls:
+            main.http_get(server.base_url + p)
+        pooled = time.perf_counter() - t0
+        pooled_conns = server.connections
+
+    print(f"📊 {n_requests} リクエスト")
+    print(f"  requests.get 直呼び: {bare:6.2f}s  接続 {bare_conns}")
+    print(f"  共有セッション     : {pooled:6.2f}s  接続 {pooled_conns}")
+
+    # 偽 transport で 503 → 429 → 200 の再試行を確認
+    url = "https://fake.example/img.jpg"
+    transport = FakeTransport({url: [
+        (503, b"", {}),
+        (429, b"", {"Retry-After": "0"}),
+        (200, b"ok", {}),
+    ]})
+    main.set_http_session(main.create_http_session(adapter=transport))
+    main.HTTP_BACKOFF = 0.01
+    r = main.http_get(url)
+    assert r.status_code == 200 and r.content == b"ok", r.status_code
+    assert len(transport.calls) == 3, transport.calls
+    print("  偽 transport: 503 → 429 → 200 を 3 回目で取得 ✅")
+
+    # 長すぎる Retry-After は HTTP_RETRY_AFTER_MAX で切り詰める
+    transport = FakeTransport({url: [(429, b"", {"Retry-After": "3600"}), (200, b"ok", {})]})
+    main.set_http_session(main.create_http_session(adapter=transport))
+    main.HTTP_RETRY_AFTER_MAX = 0.05
+    t0 = time.perf_counter()
+    r = _quiet(main.http_get, url)
+    waited = time.perf_counter() - t0
+    assert r.status_code == 200 and waited < 1, waited
+    print(f"  偽 transport: Retry-After 3600s → {waited * 1000:.0f}ms 待って再試行 ✅")
+    main.set_http_session(None)
+
+
+# ===========================
+# 偽 Atom フィード
+# ===========================
+def make_atom_routes(entries, per_page=10, path="/atom/entry"):
+    """entries（新しい順の dict: id / edited / content）を AtomPub のページに分割する"""
+    routes = {}
+    pages = [entries[i:i + per_page] for i in range(0, len(entries), per_page)] or [[]]
+    for n, page in enumerate(pages, 1):
+        url = path if n == 1 else f"{path}?page={n}"
+        body = ['<?xml version="1.0" encoding="utf-8"?>',
+                '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:app="http://www.w3.org/2007/app">']
+        if n < len(pages):
+            body.append(f'<link rel="next" href="{{base}}{path}?page={n + 1}"/>')
+        for e in page:
+            body.append(
+                f"<entry><id>{escape(e['id'])}</id>"
+                f"<title>{escape(e.get('title', ''))}</title>"
+                + "".join(f'<category term="{escape(c)}"/>' for c in e.get("categories", []))
+                + f"<published>{e.get('published', e['edited'])}</published>"
+                f"<updated>{e['edited']}</updated><app:edited>{e['edited']}</app:edited>"
+                f'<content type="text/html">{escape(e["content"])}</content></entry>'
+            )
+        body.append("</feed>")
+        routes[url] = "\n".join(body)
+    return routes
+
+
+def _serve_atom(server, entries):
+    server.routes = {
+        url: body.replace("{base}", server.base_url).encode("utf-8")
+        for url, body in make_atom_routes(entries).items()
+    }
+
+
+def make_atom_entries(n, start=None):
+    start = start or datetime(2025, 1, 1, tzinfo=timezone(timedelta(hours=9)))
+    entries = []
+    for i in range(n, 0, -1):
+        ts = (start + timedelta(hours=i)).isoformat()
+        entries.append({
+            "id": f"tag:blog.hatena.ne.jp,2013:blog-bench-6802418398336734667-{10 ** 17 + i}",
+            "title": f"記事 {i}",
+            "categories": ["キノコ"],
+            "edited": ts,
+            "content": f'<div class="entry-body"><p><img src="https://img.example/{i}.jpg" alt="キノコ{i % 50}"></p></div>',
+        })
+    return entries
+
+
+# ===========================
+# 差分 Atom 同期の API 回数と所要時間
+# ===========================
+def bench_atom_sync(n_entries=300, latency=0.02):
+    entries = make_atom_entries(n_entries)
+
+    with StandInServer({}, latency=latency, content_type="application/atom+xml") as server, _workdir():
+        main.ATOM_ENDPOINT = server.base_url + "/atom/entry"
+        print(f"📊 {n_entries} 記事 / 10件ずつ / 1ページ遅延 {latency * 1000:.0f}ms")
+
+        def run(label, **kwargs):
+            _serve_atom(server, entries)
+            before = {p: os.stat(p).st_mtime_ns for p in glob.glob("articles/*.html")}
+            server.reset()
+            t0 = time.perf_counter()
+            _quiet(main.fetch_hatena_articles_api, **kwargs)
+            elapsed = time.perf_counter() - t0
+            after = {p: os.stat(p).st_mtime_ns for p in glob.glob("articles/*.html")}
+            written = sum(1 for p, m in after.items() if before.get(p) != m)
+            calls = sum(server.requests.values())
+            print(f"  {label:<18} API {calls:>3} 回  書き込み {written:>3} 件  {elapsed:6.2f}s")
+            return calls, written
+
+        run("初回（全件）")
+        calls, written = run("変更なし")
+        assert (calls, written) == (1, 0), (calls, written)
+
+        # 新着 1 件 + 1ページ目の記事を 1 件編集
+        newest = datetime.fromisoformat(entries[0]["edited"])
+        entries.insert(0, dict(make_atom_entries(1)[0], id="tag:new-entry",
+                               edited=(newest + timedelta(hours=1)).isoformat()))
+        entries[3] = dict(entries[3], content=entries[3]["content"] + "<p>追記</p>",
+                          edited=(newest + timedelta(hours=2)).isoformat())
+        calls, written = run("新着1 + 編集1")
+        assert written == 2, written
+
+        run("全件再同期", full_resync=True)
+
+        # 記事を 1 件削除 → 全件再同期でファイルが消えること
+        gone = entries.pop(5)
+        gone_file = f"articles/entry_{main.article_key(gone['id'])}.html"
+        assert os.path.exists(gone_file)
+        run("削除1 → 全件再同期", full_resync=True)
+        assert not os.path.exists(gone_file)
+        index = main._load_json(main.ARTICLES_INDEX_FILE, {})
+        assert len(index["entries"]) == len(entries)
+
+        # 差分同期のままでも、前回の全件同期から HATENA_FULL_SYNC_DAYS 日たてば削除を拾う
+        gone = entries.pop(5)
+        gone_file = f"articles/entry_{main.article_key(gone['id'])}.html"
+        calls, _ = run("削除1 → 差分同期")
+        assert calls == 1 and os.path.exists(gone_file), calls
+        index = main._load_json(main.ARTICLES_INDEX_FILE, {})
+        index["last_full_sync"] = (datetime.now(timezone.utc) - timedelta(days=main.HATENA_FULL_SYNC_DAYS)).isoformat()
+        main._save_json(main.ARTICLES_INDEX_FILE, index)
+        run(f"{main.HATENA_FULL_SYNC_DAYS:g} 日後 → 自動で全件")
+        assert not os.path.exists(gone_file)
+        index = main._load_json(main.ARTICLES_INDEX_FILE, {})
+        assert len(index["entries"]) == len(entries)
+        assert datetime.now(timezone.utc) - datetime.fromisoformat(index["last_full_sync"]) < timedelta(minutes=1)
+
+
+# ===========================
+# 画像抽出：旧 BeautifulSoup 版との一致と速度
+# ===========================
+def reference_extract_images(html_text, exclude_patterns):
+    """ストリーミング化する前の fetch_images と同じ抽出（比較用）"""
+    soup = BeautifulSoup(html_text, "html.parser")
+    body_div = soup.find(class_="entry-body") or soup
+
+    for iframe in body_div.find_all("iframe"):
+        title = iframe.get("title", "")
+        if any(re.search(p, title) for p in exclude_patterns):
+            iframe.decompose()
+
+    for a in body_div.find_all("a"):
+        text = a.get_text(strip=True)
+        if any(re.search(p, text) for p in exclude_patterns):
+            a.decompose()
+
+    images = []
+    for img in body_div.find_all("img"):
+        alt = (img.get("alt") or "").strip()
+        src = img.get("src")
+        if not alt or not src:
+            continue
+        if any(re.search(p, alt) for p in exclude_patterns):
+            continue
+        images.append({"alt": alt, "src": src})
+    return images
+
+
+# 崩れたマークアップや入れ子の境界ケース
+EDGE_CASE_HTML = [
+    '<div class="entry-body"><img src="a.jpg" alt="A"></div><img src="b.jpg" alt="B">',
+    '<img src="b.jpg" alt="外"><div class="x entry-body y"><p><img src="a.jpg" alt=" A "></div>',
+    '<div class="entry-body"><a href="#">はてなブックマーク<img src="a.jpg" alt="A"></a><img src=c.jpg alt=C></div>',
+    '<a>はてな<b>ブックマーク</b><img src="a.jpg" alt="A"></a><img src="d.jpg" alt="2024年の秋">',
+    '<div class="entry-body"><iframe title="キノコと田舎遊び"><a>x<img src="a.jpg" alt="A"></a></iframe><img src="b.jpg" alt="B"/></div>',
+    '<a><div class="entry-body"><img src="a.jpg" alt="A"></div>はてなブックマーク</a>',
+    '<div class="entry-body"><a>ワ<script>行</script><img src="a.jpg" alt="A"></a></div><div class="entry-body"><img src="z.jpg" alt="Z"></div>',
+    '<div class="entry-body"><a>ワ行</a><img src="a.jpg" alt="A"><img alt="no-src"><img src="x.jpg"></div>',
+    '<div class="entry-body"><p><a>ワ<!-- c -->行<img src="a.jpg" alt="A"></p></a></div>',
+    '<img class="entry-body" src="a.jpg" alt="A"><img src="b.jpg" alt="B">',
+    '<div class="entry-body"><br></br><img src="a.jpg" alt="A&amp;B"></img><a>&#x30EF;行<img src="c.jpg" alt="C"></a></div>',
+    '<span class="entry-body"><a>キノコと<img src="a.jpg" alt="A">田舎遊び</a></span></span><img src="b.jpg" alt="B">',
+]
+
+
+def _fixture_pages():
+    pages = []
+    for pattern in ("articles/*.html", "restore_html/*"):
+        for path in sorted(glob.glob(os.path.join(REPO_DIR, pattern))):
+            if path.endswith((".css", ".js")):
+                continue
+            with open(path, encoding="utf-8", errors="replace") as f:
+                pages.append((os.path.relpath(path, REPO_DIR), f.read()))
+    pages += [(f"edge-case #{i}", html_text) for i, html_text in enumerate(EDGE_CASE_HTML)]
+    return pages
+
+
+def bench_extract_images(rounds=3):
+    pages = _fixture_pages()
+    patterns = main.EXCLUDE_PATTERNS
+    exclude = main.ExcludeFilter(patterns)
+
+    mismatches = 0
+    total_images = 0
+    for name, html_text in pages:
+        expected = reference_extract_images(html_text, patterns)
+        got = main.extract_images_from_html(html_text, exclude)
+        total_images += len(expected)
+        if got != expected:
+            mismatches += 1
+            print(f"  ❌ {name}: 旧 {len(expected)} 枚 / 新 {len(got)} 枚")
+    if mismatches:
+        raise AssertionError(f"{mismatches} ページで旧実装と一致しません")
+    print(f"✅ {len(pages)} ページ（画像 {total_images} 枚）で旧 BeautifulSoup 版と一致")
+
+    total_bytes = sum(len(h.encode("utf-8")) for _, h in pages)
+    for label, func, arg in (("BeautifulSoup", reference_extract_images, patterns),
+                             ("ストリーミング", main.extract_images_from_html, exclude)):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for _, html_text in pages:
+                func(html_text, arg)
+        elapsed = time.perf_counter() - t0
+        n = len(pages) * rounds
+        print(f"  {label:<14} {n / elapsed:8.1f} pages/s  {total_bytes * rounds / elapsed / 1e6:6.1f} MB/s")
+
+
+# ===========================
+# 除外判定：パターンごとの re.search と 1 本化した正規表現
+# ===========================
+def bench_exclude_filter(n_strings=200_000):
+    patterns = main.EXCLUDE_PATTERNS
+    samples = ["ベニテングタケ", "この記事をはてなブックマークに追加", "2024年10月の観察",
+               "ワ行", "キノコと田舎遊び", "タマゴタケ 幼菌", "", "id:exsudoporus_ruber"]
+    strings = [samples[i % len(samples)] for i in range(n_strings)]
+
+    t0 = time.perf_counter()
+    old = [any(re.search(p, t) for p in patterns) for t in strings]
+    t_old = time.perf_counter() - t0
+
+    exclude = main.ExcludeFilter(patterns)
+    t0 = time.perf_counter()
+    new = [exclude(t) for t in strings]
+    t_new = time.perf_counter() - t0
+
+    assert old == new
+    print(f"📊 {n_strings:,} 文字列 × {len(patterns)} パターン（判定結果は一致）")
+    print(f"  any(re.search)  : {t_old:6.2f}s")
+    print(f"  ExcludeFilter   : {t_new:6.2f}s")
+    exclude.print_stats()
+
+    # 連結するとグループ番号がずれるパターン・包めないパターンも元の判定と一致すること
+    tricky = [r"x", r"(a)\1", r"(?P<w>[ワヲ])(?P=w)", r"(?i)kinoko", r"^(\d+)年\1月$"]
+    texts = ["aa", "ab", "ワワ", "ワヲ", "KINOKO", "2024年2024月", "2024年10月", "x", "", "タマゴタケ"]
+    exclude = main.ExcludeFilter(tricky)
+    got = [exclude(t) for t in texts]
+    expected = [any(re.search(p, t) for p in tricky) for t in texts]
+    if got != expected:
+        raise AssertionError(f"後方参照・インラインフラグ入りのパターンで判定が変わりました: {got} != {expected}")
+    print(f"✅ 後方参照・インラインフラグを含む {len(tricky)} パターンでも判定が一致")
+
+    # パターンファイル：無ければ組み込み、あるのに壊れていれば黙って組み込みに戻さず止める
+    with _workdir():
+        if _quiet(main.ExcludeFilter.load, "exclude-patterns.json").patterns != list(main.EXCLUDE_PATTERNS):
+            raise AssertionError("ファイルが無いときに組み込みのパターンになっていません")
+        for label, content in (("JSON の誤り", '["はてな",]'), ("配列でない", '"はてな"'),
+                               ("文字列でない要素", '["はてな", 1]'), ("正規表現の誤り", '["(はてな"]')):
+            with open("exclude-patterns.json", "w", encoding="utf-8") as f:
+                f.write(content)
+            try:
+                _quiet(main.ExcludeFilter.load, "exclude-patterns.json")
+            except ValueError:
+                continue
+            raise AssertionError(f"壊れたパターンファイル（{label}）で組み込みのパターンに戻りました")
+    print("✅ パターンファイルが無ければ組み込み / 壊れていれば止める")
+
+
+# ===========================
+# 記事解析：逐次とプロセス並列
+# ===========================
+def bench_parallel_extract(n_articles=1000):
+    pages = [h for _, h in _fixture_pages()]
+
+    with _workdir():
+        os.makedirs(main.ARTICLES_DIR)
+        for i in range(n_articles):
+            # 内容ハッシュが重ならないよう末尾に通し番号を入れる
+            with open(f"{main.ARTICLES_DIR}/entry_{i:06d}.html", "w", encoding="utf-8") as f:
+                f.write(pages[i % len(pages)] + f"<!-- {i} -->")
+
+        cpus = os.cpu_count() or 1
+        print(f"📊 {n_articles} 記事 / CPU {cpus} コア")
+        baseline = None
+        for workers in sorted({1, 2, cpus}):
+            if os.path.exists(main.IMAGES_CACHE_FILE):
+                os.remove(main.IMAGES_CACHE_FILE)
+            t0 = time.perf_counter()
+            entries = _quiet(main.fetch_images, workers=workers)
+            elapsed = time.perf_counter() - t0
+
+            if baseline is None:
+                baseline = entries
+            elif entries != baseline:
+                raise AssertionError(f"workers={workers} の抽出結果が逐次版と一致しません")
+            print(f"  workers={workers:>2}: {elapsed:6.2f}s  {n_articles / elapsed:7.1f} pages/s")
+        print(f"✅ 画像 {len(baseline)} 件の並びが全ワーカー数で一致")
+
+
+def _fixture_entries(n_articles):
+    """フィクスチャ記事を articles/ に並べて fetch_images し、(entries, exif_cache) を返す"""
+    pages = [h for _, h in _fixture_pages()]
+    os.makedirs(main.ARTICLES_DIR, exist_ok=True)
+    for i in range(n_articles):
+        with open(f"{main.ARTICLES_DIR}/entry_{i:06d}.html", "w", encoding="utf-8") as f:
+            f.write(pages[i % len(pages)] + f"<!-- {i} -->")
+    entries = _quiet(main.fetch_images, workers=1)
+    exif_cache = {
+        e["src"]: {"model": "Bench", "lens": "Macro 50mm", "iso": "400", "f": "f/2.8",
+                   "exposure": "1/125", "focal": "50mm", "date": "2024/01/01"}
+        for e in entries
+    }
+    main.save_image_records({src: {"status": "ok", "exif": exif} for src, exif in exif_cache.items()})
+    return entries, exif_cache
+
+
+def _output_size():
+    files = [p for p in glob.glob(f"{main.OUTPUT_DIR}/**/*", recursive=True) if os.path.isfile(p)]
+    html_files = [p for p in files if p.endswith(".html")]
+    return len(html_files), sum(os.path.getsize(p) for p in files)
+
+
+def _build_output(entries, exif_cache):
+    grouped = _quiet(main.generate_gallery, entries, exif_cache)
+    _quiet(main.generate_index, grouped, exif_cache)
+    _quiet(main.generate_favorite_page, grouped)
+
+
+def bench_asset_size(n_articles=113):
+    with _workdir():
+        entries, exif_cache = _fixture_entries(n_articles)
+
+        # 変更前：全ページに STYLE_TAG / SCRIPT_TAG を埋め込む
+        original = main.page_assets
+        main.page_assets = lambda: {"style": main.STYLE_TAG, "script": main.SCRIPT_TAG}
+        try:
+            _build_output(entries, exif_cache)
+        finally:
+            main.page_assets = original
+        pages, inline_bytes = _output_size()
+
+        shutil.rmtree(main.OUTPUT_DIR)
+        os.remove(main.OUTPUT_MANIFEST_FILE)
+        _build_output(entries, exif_cache)
+        _, shared_bytes = _output_size()
+        assets = sorted(os.listdir(main.ASSETS_DIR))
+
+        print(f"📊 {len(entries)} 枚 / {pages} ページ")
+        print(f"  インライン : {inline_bytes:>12,} bytes")
+        print(f"  共通アセット: {shared_bytes:>12,} bytes  ({', '.join(assets)})")
+        print(f"✅ {inline_bytes - shared_bytes:,} bytes 削減（{1 - shared_bytes / inline_bytes:.1%}）")
+
+        # gallery.js がブログに埋め込む index.html からも解決できる絶対 URL で参照する
+        with open(f"{main.OUTPUT_DIR}/index.html", encoding="utf-8") as f:
+            hrefs = re.findall(r'(?:href|src)="([^"]*/assets/[^"]+)"', f.read())
+        base = main.SITE_BASE_URL.rstrip("/") + "/"
+        if len(hrefs) != 2 or any(not h.startswith(base) or not os.path.exists(f"{main.OUTPUT_DIR}/{h[len(base):]}")
+                                  for h in hrefs):
+            raise AssertionError(f"アセットの参照が公開先の絶対 URL になっていません: {hrefs}")
+        print(f"✅ アセットは {base}assets/ から参照（埋め込み先のドメインに依存しない）")
+
+        # 内容が変われば名前も変わり、古い版は消える
+        main.STYLE_TAG, saved = main.STYLE_TAG.replace("</style>", "\n</style>"), main.STYLE_TAG
+        try:
+            _quiet(main.page_assets)
+        finally:
+            main.STYLE_TAG = saved
+        css = [a for a in os.listdir(main.ASSETS_DIR) if a.endswith(".css")]
+        if len(css) != 1 or css[0] in assets:
+            raise AssertionError(f"古い CSS が残っています: {css}")
+        print(f"✅ 内容変更で {css[0]} に差し替え、旧版を削除")
+
+
+# ===========================
+# 差分出力（変わったページだけ書く・消えたキノコのページを消す）
+# ===========================
+def _gallery_pass(entries, exif_cache):
+    """generate_gallery を 1 回回し、(秒, ページ書き込み数, 削除数) を返す"""
+    with main.build_stage("gallery") as stage:
+        _quiet(main.generate_gallery, entries, exif_cache)
+    counters = stage["counters"]
+    return stage["seconds"], counters.get("pages_written", 0), counters.get("pages_removed", 0)
+
+
+def _page_mtimes():
+    return {p: os.stat(p).st_mtime_ns for p in glob.glob(f"{main.OUTPUT_DIR}/*.html")}
+
+
+def bench_incremental_output(n_articles=113):
+    with _workdir():
+        entries, exif_cache = _fixture_entries(n_articles)
+
+        cold, written, _ = _gallery_pass(entries, exif_cache)
+        mtimes = _page_mtimes()
+        warm, rewritten, _ = _gallery_pass(entries, exif_cache)
+        print(f"📊 {len(entries)} 枚 / {len(mtimes)} ページ")
+        print(f"  初回    : {cold:6.2f}s  書き込み {written}")
+        print(f"  変更なし: {warm:6.2f}s  書き込み {rewritten}")
+        if rewritten or _page_mtimes() != mtimes:
+            raise AssertionError(f"同じ入力の再実行でページを書き込みました: {rewritten}")
+
+        # 1 種類のキノコの画像をすべて外すと、そのページが消える
+        names = sorted({e["alt"] for e in entries})
+        gone = next(n for n in names if sum(main.safe_filename(m) == main.safe_filename(n) for m in names) == 1)
+        page = f"{main.OUTPUT_DIR}/{main.safe_filename(gone)}.html"
+        if not os.path.exists(page):
+            raise AssertionError(f"ページがありません: {page}")
+        _, rewritten, removed = _gallery_pass([e for e in entries if e["alt"] != gone], exif_cache)
+        print(f"  「{gone}」を削除: 書き込み {rewritten} / 削除 {removed}")
+        if os.path.exists(page) or removed != 1:
+            raise AssertionError(f"消えたキノコのページが残っています: {page}")
+    main.BUILD_STAGES.clear()
+    print("✅ 同じ入力では 0 ページ書き込み / 消えたキノコのページを削除")
+
+
+# ===========================
+# 画像 1 枚 1 回の処理（EXIF・寸法・pHash・サムネイル）
+# ===========================
+def _hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def bench_image_pass(n_images=16):
+    from PIL import Image, ImageOps
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+
+    # 同じ写真の縮小・再圧縮版と、無関係な画像（pHash の比較用）
+    original = ImageOps.exif_transpose(Image.open(SAMPLE_JPEG)).convert("RGB")
+    buf = io.BytesIO()
+    original.resize((original.width // 2, original.height // 2)).save(buf, "JPEG", quality=40)
+    similar = buf.getvalue()
+    buf = io.BytesIO()
+    Image.linear_gradient("L").convert("RGB").resize(original.size).save(buf, "JPEG")
+    unrelated = buf.getvalue()
+
+    routes = {f"/img/{i:05d}.jpg": jpeg for i in range(n_images)}
+    routes["/img/similar.jpg"] = similar
+    routes["/img/unrelated.jpg"] = unrelated
+    main.EXIF_HOST_RATE = 0
+    with StandInServer(routes) as server, _workdir():
+        entries = [{"alt": "bench", "src": server.base_url + p} for p in routes]
+        t0 = time.perf_counter()
+        records = _quiet(main.build_image_records, entries, {}, workers=4)
+        elapsed = time.perf_counter() - t0
+
+        if any(n != 1 for n in server.requests.values()):
+            raise AssertionError("同じ画像を 2 回以上取得しています")
+
+        src = entries[0]["src"]
+        record = records[src]
+        if record["exif"] != main.extract_exif_from_bytes(jpeg):
+            raise AssertionError("全体取得時の EXIF が一致しません")
+        print(f"📊 {len(routes)} 枚 / 元画像 {record['width']}x{record['height']} 向き {record['orientation']} {len(jpeg):,} bytes")
+        print(f"  取得+処理: {elapsed:6.2f}s  {len(routes) / elapsed:6.1f} img/s（1 枚 1 リクエスト）")
+        for w in record["widths"]:
+            sizes = [
+                os.path.getsize(os.path.join(main.OUTPUT_DIR, main.thumb_path(src, record["hash"], w, ext)))
+                for ext in ("webp", "jpg")
+            ]
+            print(f"  {w:>4}w: webp {sizes[0]:>8,} bytes / jpeg {sizes[1]:>8,} bytes")
+
+        print(f"  LQIP: {len(record['lqip']):,} bytes（data URI）")
+        # LQIP 導入前のレコードは出力済みサムネイルから補完できること
+        del records[src]["lqip"]
+        _quiet(main.fill_placeholders, records)
+        if not records[src].get("lqip", "").startswith("data:image/webp;base64,"):
+            raise AssertionError("サムネイルから LQIP を補完できません")
+
+        near = _hamming(record["phash"], records[server.base_url + "/img/similar.jpg"]["phash"])
+        far = _hamming(record["phash"], records[server.base_url + "/img/unrelated.jpg"]["phash"])
+        print(f"  pHash 距離: 縮小+再圧縮 {near} / 無関係 {far}（64 bit 中）")
+        if not near < 10 < far:
+            raise AssertionError("pHash が類似画像を見分けられていません")
+
+        # 2 回目はキャッシュのみ（リクエスト 0）
+        server.reset()
+        _quiet(main.build_image_records, entries, records, workers=4)
+        if sum(server.requests.values()):
+            raise AssertionError("処理済みの画像を再取得しています")
+
+        grouped = _quiet(main.generate_gallery, entries, main.exif_view(records), records)
+        page = open(f"{main.OUTPUT_DIR}/{main.safe_filename('bench')}.html", encoding="utf-8").read()
+        if page.count("<picture>") != len(routes) or f'src="{src}"' not in page:
+            raise AssertionError("srcset 付きの <picture> が出力されていません")
+        if page.count("has-lqip") != len(routes):
+            raise AssertionError("LQIP の下地が出力されていません")
+        print(f"✅ 2 回目は再取得なし / {len(grouped['bench'])} 枚に srcset を出力")
+
+# ===========================
+# width / height 有無でのレイアウト確定までの待ち
+# ===========================
+class _GalleryImgs(HTMLParser):
+    """.gallery 内の <img> の属性を集める"""
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.imgs = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.depth:
+            if tag == "img":
+                self.imgs.append(attrs)
+            elif tag not in main._VOID_TAGS:
+                self.depth += 1
+        elif tag == "div" and "gallery" in (attrs.get("class") or "").split():
+            self.depth = 1
+
+    def handle_endtag(self, tag):
+        if self.depth and tag not in main._VOID_TAGS:
+            self.depth -= 1
+
+
+# SCRIPT_TAG の isSizedGallery と load ハンドラをそのまま動かし、load 時の sendHeight 回数を数える
+HEIGHT_JS = """
+const data = JSON.parse(require("fs").readFileSync(0, "utf8"));
+let calls = 0;
+const sendHeight = () => calls++;
+const handlers = {};
+const window = { addEventListener: (type, fn) => { handlers[type] = fn; } };
+const setTimeout = fn => fn();
+const galleries = data.galleries.map(imgs => ({
+  classList: { contains: name => name === "gallery" },
+  querySelectorAll: () => imgs.map(attrs => ({ getAttribute: key => attrs[key] ?? null })),
+}));
+eval(data.source);
+handlers.load();
+console.log(calls);
+"""
+
+
+def _load_height_calls(node, imgs):
+    """生成されたページの .gallery <img> に対し、load 時に sendHeight が呼ばれる回数"""
+    source = (re.search(r"function isSizedGallery.*?\n}\n", main.SCRIPT_TAG, re.S).group(0)
+              + re.search(r'  window\.addEventListener\("load".*?\n  }\);\n', main.SCRIPT_TAG, re.S).group(0))
+    out = subprocess.run([node, "-e", HEIGHT_JS], input=json.dumps({"source": source, "galleries": [imgs]}),
+                         capture_output=True, text=True, check=True).stdout
+    return int(out)
+
+
+def bench_layout_metrics(n_images=24, latency=0.4, connections=6):
+    """寸法あり / なしで同じキノコページを作り、生成された <img> を静的に確かめる。
+
+    寸法なしのページは全画像の読み込み（imagesLoaded）を待ってから表示と高さ通知をするので、
+    ブラウザ並みの同時接続数で全画像を取り切るまでの時間をその待ちとして実測する。
+    寸法ありのページは DOMContentLoaded の時点で表示できる。
+    load 時の sendHeight 回数は SCRIPT_TAG の判定と load ハンドラを node で動かして数える
+    （画像ごとの読み込みや MutationObserver 由来の回数はブラウザが無いので数えない）。
+    """
+    from PIL import Image
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+    width, height = Image.open(SAMPLE_JPEG).size
+
+    image_routes = {f"/img/{i:05d}.jpg": jpeg for i in range(n_images)}
+    node = shutil.which("node")
+    main.THUMB_WIDTHS = ()
+    results = {}
+    with StandInServer(image_routes, latency=latency) as images, _workdir():
+        entries = [{"alt": "bench", "src": images.base_url + p} for p in image_routes]
+        sized = {e["src"]: {"exif": {}, "width": width, "height": height} for e in entries}
+        unsized = {e["src"]: {"exif": {}} for e in entries}
+
+        for variant, records in (("unsized", unsized), ("sized", sized)):
+            main.OUTPUT_DIR = variant
+            main.ASSETS_DIR = os.path.join(variant, "assets")
+            main.OUTPUT_MANIFEST_FILE = os.path.join(variant, "manifest.json")
+            _quiet(main.generate_gallery, entries, main.exif_view(records), records)
+            parser = _GalleryImgs()
+            with open(f"{variant}/{main.safe_filename('bench')}.html", encoding="utf-8") as f:
+                parser.feed(f.read())
+            imgs = parser.imgs
+            if len(imgs) != n_images:
+                raise AssertionError(f"{variant}: .gallery の画像が {len(imgs)} 枚")
+
+            # SCRIPT_TAG と同じ判定：全画像に width / height があれば読み込みを待たない
+            reserved = [img for img in imgs if img.get("width") and img.get("height")]
+            waits = len(reserved) != len(imgs)
+            wait = 0.0
+            if waits:
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=connections) as pool:
+                    list(pool.map(lambda img: requests.get(img["src"]).content, imgs))
+                wait = time.perf_counter() - t0
+            height_calls = _load_height_calls(node, imgs) if node else None
+            results[variant] = (len(reserved), waits, wait, height_calls)
+
+            if variant == "sized":
+                for img in imgs:
+                    w, h = int(img["width"]), int(img["height"])
+                    if (w, h) != (width, height) or f"aspect-ratio: {w} / {h}" not in img.get("style", ""):
+                        raise AssertionError(f"寸法属性が画像と一致しません: {img}")
+
+    print(f"📊 {n_images} 枚 / 画像 {width}x{height} {len(jpeg):,} bytes / 遅延 {latency * 1000:.0f}ms / 同時 {connections} 接続")
+    for variant, label in (("unsized", "寸法なし（変更前）"), ("sized", "寸法あり（変更後）")):
+        n, waits, wait, height_calls = results[variant]
+        timing = f"全画像の読み込みを待つ {wait * 1000:7.0f}ms" if waits else "待たずに表示・高さ通知"
+        calls = f"  load 時の sendHeight {height_calls} 回" if height_calls is not None else ""
+        print(f"  {label}: 枠を確保した画像 {n:>3}/{n_images}  {timing}{calls}")
+    if results["unsized"][1] is False or results["sized"][1] is True:
+        raise AssertionError("寸法の有無で表示までの待ちが変わっていません")
+    if node and results["sized"][3] >= results["unsized"][3]:
+        raise AssertionError("寸法ありのページでも load 後の高さの取り直しが残っています")
+    print("✅ 全画像に width / height / aspect-ratio を出力し、画像を待たずにレイアウトが確定")
+
+
+# ===========================
+# 検索インデックス（インライン全件 vs 文字シャード）
+# ===========================
+SEARCH_JS = """
+const data = JSON.parse(require("fs").readFileSync(0, "utf8"));
+const all = data.all;
+const shards = Object.fromEntries(
+  Object.entries(data.shards).map(([ch, rows]) =>
+    [ch, rows.map(([name, name_norm, href, thumb]) => ({ name, name_norm, href, thumb }))])
+);
+// クライアントと同じく件数が一番少ないシャードを使う
+const pick = q => {
+  let best = null;
+  for (const ch of new Set(q)) {
+    if (!shards[ch]) return null;
+    if (best === null || shards[ch].length < shards[best].length) best = ch;
+  }
+  return best;
+};
+const time = fn => {
+  const t0 = process.hrtime.bigint();
+  for (let i = 0; i < data.rounds; i++) for (const q of data.queries) fn(q);
+  return Number(process.hrtime.bigint() - t0) / 1e3 / data.rounds / data.queries.length;
+};
+console.log(JSON.stringify({
+  inline: time(q => all.filter(m => (m.name_norm || "").includes(q))),
+  sharded: time(q => (shards[pick(q)] || []).filter(m => m.name_norm.includes(q))),
+}));
+"""
+
+
+def make_mushroom_names(n, seed=0):
+    """カタカナのキノコ名っぽい重複なしの名前を n 個作る"""
+    rng = random.Random(seed)
+    kana = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+    suffixes = ["タケ", "ダケ", "テングタケ", "イグチ", "ベニタケ", "ホウキタケ", "キクラゲ", "ハツ", "シメジ"]
+    names = set()
+    while len(names) < n:
+        stem = "".join(rng.choice(kana) for _ in range(rng.randint(1, 5)))
+        names.add(stem + rng.choice(suffixes))
+    return sorted(names)
+
+
+def bench_search_index(sizes=(1_000, 10_000, 50_000), n_queries=200):
+    node = shutil.which("node")
+    for n in sizes:
+        names = make_mushroom_names(n)
+        grouped = {name: [f"https://cdn-ak.f.st-hatena.com/images/fotolife/b/bench/{i:08d}.jpg"]
+                   for i, name in enumerate(names)}
+        rng = random.Random(n)
+        # 入力途中を再現：名前の途中 1〜3 文字
+        queries = []
+        for name in rng.sample(names, n_queries):
+            start = rng.randrange(len(name))
+            queries.append(main.search_key(name[start:start + rng.randint(1, 3)]))
+
+        inline = [{"name": a, "name_norm": main.search_key(a), "href": f"{main.safe_filename(a)}.html",
+                   "thumb": s[0] + "?width=300"} for a, s in grouped.items()]
+        inline_bytes = len(json.dumps(inline, ensure_ascii=False).encode("utf-8"))
+
+        with _workdir():
+            manifest = _quiet(main.write_search_index, grouped)
+            manifest_bytes = len(json.dumps({"base": "search/", "shards": manifest},
+                                            ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            shard_bytes = {
+                ch: os.path.getsize(os.path.join(main.SEARCH_DIR, f"{ord(ch):x}.{h}.json"))
+                for ch, (h, _) in manifest.items()
+            }
+        shards = main.build_search_shards(grouped)
+        picked = [min(set(q), key=lambda ch: manifest[ch][1]) for q in queries]
+        fetched = [shard_bytes[ch] for ch in picked]
+
+        # 結果（順序込み）が全件の線形検索と一致すること
+        for q, ch in zip(queries, picked):
+            expected = [m["name"] for m in inline if q in m["name_norm"]]
+            if [r[0] for r in shards[ch] if q in r[1]] != expected:
+                raise AssertionError(f"{q!r} の検索結果が全件検索と一致しません")
+
+        print(f"📊 {n:,} 件（シャード {len(manifest)} 個）")
+        print(f"  index.html に埋め込む量: 全件 {inline_bytes:>12,} bytes → 目次 {manifest_bytes:>8,} bytes")
+        print(f"  1 クエリで取るシャード : 平均 {sum(fetched) / len(fetched):>12,.0f} bytes / 最大 {max(fetched):,} bytes")
+
+        if node:
+            payload = json.dumps({"all": inline, "shards": shards, "queries": queries, "rounds": 5},
+                                 ensure_ascii=False)
+            out = subprocess.run([node, "-e", SEARCH_JS], input=payload, capture_output=True,
+                                 text=True, check=True).stdout
+            us = json.loads(out)
+            print(f"  1 キー入力あたり（node） : 全件 {us['inline']:>9.1f} µs → シャード {us['sharded']:>8.1f} µs")
+    if not node:
+        print("ℹ️ node が無いのでクエリ時間の計測は省略")
+
+
+# ===========================
+# 検索キー（かな・ローマ字の揺れ）の照合コーパス
+# ===========================
+SEARCH_CORPUS_NAMES = [
+    "ベニテングタケ", "ヒメベニテングタケ", "タマゴタケ", "シイタケ", "マツタケ", "ハツタケ",
+    "ルリハツタケ", "チャナメツムタケ", "ショウゲンジ", "アンズタケ", "ヌメリイグチ", "ツチグリ",
+    "キッコウアワタケ", "ヤマドリタケモドキ", "オニフスベ", "スッポンタケ", "ショウロ", "ニセショウロ",
+    "ドクツルタケ", "ツキヨタケ", "カエンタケ", "ムラサキシメジ", "ホンシメジ", "ナメコ", "コガネニカワタケ",
+    "マッチャイグチ", "ボッチャンタケ",
+]
+
+# (クエリ, 期待する結果)
+SEARCH_CORPUS = [
+    ("べにてんぐ", ["ベニテングタケ", "ヒメベニテングタケ"]),
+    ("ﾍﾞﾆﾃﾝｸﾞ", ["ベニテングタケ", "ヒメベニテングタケ"]),
+    ("tengu", ["ベニテングタケ", "ヒメベニテングタケ"]),
+    ("しいたけ", ["シイタケ"]),
+    ("shiitake", ["シイタケ"]),
+    ("siitake", ["シイタケ"]),
+    ("matsutake", ["マツタケ"]),
+    ("はつたけ", ["ハツタケ", "ルリハツタケ"]),
+    ("hatsutake", ["ハツタケ", "ルリハツタケ"]),
+    ("チャナメ", ["チャナメツムタケ"]),
+    ("ちやなめ", ["チャナメツムタケ"]),
+    ("chaname", ["チャナメツムタケ"]),
+    ("しょうげんじ", ["ショウゲンジ"]),
+    ("shougenji", ["ショウゲンジ"]),
+    ("syougenzi", ["ショウゲンジ"]),
+    ("すっぽん", ["スッポンタケ"]),
+    ("suppon", ["スッポンタケ"]),
+    ("しょうろ", ["ショウロ", "ニセショウロ"]),
+    ("きつこう", ["キッコウアワタケ"]),
+    ("ｼﾒｼﾞ", ["ムラサキシメジ", "ホンシメジ"]),
+    ("shimeji", ["ムラサキシメジ", "ホンシメジ"]),
+    ("なめこ", ["ナメコ"]),
+    ("dokutsuru", ["ドクツルタケ"]),
+    ("tsukiyo", ["ツキヨタケ"]),
+    ("ANZU", ["アンズタケ"]),
+    ("ぐち", ["ヌメリイグチ", "マッチャイグチ"]),
+    ("にかわ", ["コガネニカワタケ"]),
+    ("matcha", ["マッチャイグチ"]),
+    ("mattya", ["マッチャイグチ"]),
+    ("botchan", ["ボッチャンタケ"]),
+    ("キノコ", []),
+]
+
+KEYS_JS = """
+const data = JSON.parse(require("fs").readFileSync(0, "utf8"));
+eval(data.source);
+console.log(JSON.stringify(data.texts.map(t => [searchKey(t), romajiCanon(t), isRomajiQuery(t)])));
+"""
+
+
+def _search(shards, manifest, query):
+    """クライアントの doSearch と同じ手順で検索する"""
+    romaji = re.fullmatch(r"[a-z0-9' -]+", unicodedata.normalize("NFKC", query).lower()) is not None
+    q = main.romaji_canon(query) if romaji else main.search_key(query)
+    if any(ch not in manifest for ch in q):
+        return []
+    ch = min(set(q), key=lambda c: manifest[c][1])
+    return [row[0] for row in shards[ch] if q in (row[4] if romaji else row[1])]
+
+
+def bench_search_keys():
+    grouped = {name: [f"https://example.com/{i}.jpg"] for i, name in enumerate(SEARCH_CORPUS_NAMES)}
+    with _workdir():
+        manifest = _quiet(main.write_search_index, grouped)
+    shards = main.build_search_shards(grouped)
+
+    failed = 0
+    for query, expected in SEARCH_CORPUS:
+        got = _search(shards, manifest, query)
+        ok = got == expected
+        failed += not ok
+        print(f"  {'✅' if ok else '❌'} {query:<18} → {', '.join(got) or '（なし）'}")
+    if failed:
+        raise AssertionError(f"{failed} 件のクエリが期待どおりに一致しません")
+
+    # クライアント側（SCRIPT_TAG の searchKey / romajiCanon）が同じキーを作ること
+    node = shutil.which("node")
+    if not node:
+        print("ℹ️ node が無いので JS 側との照合は省略")
+        return
+    source = re.search(r"const SMALL_KANA = .*?(?=\n  function highlight)", main.SCRIPT_TAG, re.S).group(0)
+    texts = SEARCH_CORPUS_NAMES + [q for q, _ in SEARCH_CORPUS]
+    out = subprocess.run([node, "-e", KEYS_JS], input=json.dumps({"source": source, "texts": texts}),
+                         capture_output=True, text=True, check=True).stdout
+    for text, (key, canon, is_romaji) in zip(texts, json.loads(out)):
+        expected = [main.search_key(text), main.romaji_canon(text),
+                    re.fullmatch(r"[a-z0-9' -]+", unicodedata.normalize("NFKC", text).lower()) is not None]
+        if [key, canon, is_romaji] != expected:
+            raise AssertionError(f"{text!r}: JS {[key, canon, is_romaji]} != Python {expected}")
+    print(f"✅ {len(SEARCH_CORPUS)} クエリが期待どおり / JS と Python のキーが {len(texts)} 件で一致")
+
+
+# ===========================
+# 観察ノートのメタデータ（全件埋め込み vs 写真シャード）
+# ===========================
+META_JS = """
+const data = JSON.parse(require("fs").readFileSync(0, "utf8"));
+eval(data.source);
+console.log(JSON.stringify(data.srcs.map(src => photoMetaShard(src, data.digits))));
+"""
+
+
+def bench_favorite_meta(n_photos=5_000, n_favorites=10, n_mushrooms=400):
+    rng = random.Random(0)
+    names = make_mushroom_names(n_mushrooms)
+    grouped = {}
+    exif_cache = {}
+    for i in range(n_photos):
+        src = f"https://cdn-ak.f.st-hatena.com/images/fotolife/b/bench/2024{i % 12 + 1:02d}01/2024{i:010d}.jpg"
+        grouped.setdefault(names[i % n_mushrooms], []).append(src)
+        exif_cache[src] = {"model": "OM-1", "lens": "M.Zuiko 60mm F2.8 Macro", "iso": str(rng.choice([200, 400, 800])),
+                           "f": "f/5.6", "exposure": "1/125", "focal": "60mm",
+                           "date": f"2024/{i % 12 + 1:02d}/{i % 28 + 1:02d}"}
+
+    # 変更前：favorite.html に EXIF_CACHE と SRC_TO_ALT を全件埋め込み
+    src_to_alt = {src: alt for alt, srcs in grouped.items() for src in srcs}
+    inline_bytes = len(json.dumps(exif_cache, ensure_ascii=False).encode("utf-8")) + \
+        len(json.dumps(src_to_alt, ensure_ascii=False).encode("utf-8"))
+
+    with _workdir():
+        index = main.write_photo_meta(grouped, exif_cache)
+        index_bytes = len(json.dumps(index, separators=(",", ":")).encode("utf-8"))
+        favorites = rng.sample(sorted(src_to_alt), n_favorites)
+        needed = {main.photo_meta_shard(src) for src in favorites}
+        fetched = 0
+        for key in needed:
+            path = os.path.join(main.META_DIR, f"{key}.{index['shards'][key]}.json")
+            fetched += os.path.getsize(path)
+            with open(path, encoding="utf-8") as f:
+                shard = json.load(f)
+            for src in favorites:
+                if main.photo_meta_shard(src) == key and shard[src] != [src_to_alt[src], exif_cache[src]["date"]]:
+                    raise AssertionError(f"{src} のメタデータが一致しません")
+
+    print(f"📊 {n_photos:,} 枚 / ★ {n_favorites} 枚 / シャード {len(index['shards'])} 個")
+    print(f"  変更前（全件埋め込み）: {inline_bytes:>10,} bytes")
+    print(f"  目次 + シャード {len(needed)} 個 : {index_bytes + fetched:>10,} bytes（目次 {index_bytes:,} + 取得 {fetched:,}）")
+    print(f"✅ {1 - (index_bytes + fetched) / inline_bytes:.1%} 削減")
+
+    node = shutil.which("node")
+    if node:
+        source = re.search(r"function photoMetaShard.*?\n    }\n", main.SCRIPT_TAG, re.S).group(0)
+        srcs = favorites + ["https://例え.jp/きのこ.jpg"]
+        out = subprocess.run([node, "-e", META_JS],
+                             input=json.dumps({"source": source, "srcs": srcs, "digits": main.META_SHARD_HEX}),
+                             capture_output=True, text=True, check=True).stdout
+        if json.loads(out) != [main.photo_meta_shard(src) for src in srcs]:
+            raise AssertionError("JS と Python のシャード割り当てが一致しません")
+        print("✅ JS と Python のシャード割り当てが一致")
+
+
+# ===========================
+# 画像キャッシュの形式（素の dict JSON vs 列指向）
+# ===========================
+def make_image_records(n, seed=0):
+    rng = random.Random(seed)
+    cameras = [("OM-1", "M.Zuiko 60mm F2.8 Macro"), ("E-M1MarkIII", "M.Zuiko 12-45mm F4.0 PRO"),
+               ("TG-6", ""), ("iPhone 13 mini", "iPhone 13 mini back dual camera 5.1mm f/1.6")]
+    records = {}
+    for i in range(n):
+        month = i % 12 + 1
+        model, lens = rng.choice(cameras)
+        src = f"https://cdn-ak.f.st-hatena.com/images/fotolife/b/bench/2024{month:02d}{i % 28 + 1:02d}/2024{i:010d}.jpg"
+        records[src] = {
+            "rev": 1,
+            "exif": {"model": model, "lens": lens, "iso": str(rng.choice([200, 400, 800, 1600])),
+                     "f": rng.choice(["f/2.8", "f/4.0", "f/5.6", "f/8.0"]),
+                     "exposure": rng.choice(["1/60", "1/125", "1/250"]), "focal": rng.choice(["12mm", "60mm"]),
+                     "date": f"2024/{month:02d}/{i % 28 + 1:02d}"},
+            "width": 1200, "height": rng.choice([900, 1600]), "orientation": 1,
+            "phash": f"{rng.getrandbits(64):016x}",
+            "lqip": "data:image/webp;base64," + base64.b64encode(rng.randbytes(135)).decode(),
+            "hash": f"{rng.getrandbits(40):010x}",
+            "widths": [200, 400, 800],
+        }
+    return records
+
+
+def bench_image_records(sizes=(10_000, 100_000)):
+    for n in sizes:
+        records = make_image_records(n)
+        with _workdir():
+            # 変更前：indent=2 の dict をそのまま
+            t0 = time.perf_counter()
+            with open("legacy.json", "w", encoding="utf-8") as f:
+                json.dump(records, f, ensure_ascii=False, indent=2)
+            legacy_save = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            with open("legacy.json", encoding="utf-8") as f:
+                json.load(f)
+            legacy_load = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            main.save_image_records(records)
+            save = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            loaded = main.load_image_records()
+            load = time.perf_counter() - t0
+            if loaded != records:
+                raise AssertionError("列指向の往復でレコードが変わりました")
+
+            legacy_size = os.path.getsize("legacy.json")
+            size = os.path.getsize(main.IMAGE_RECORDS_FILE)
+            print(f"📊 {n:,} 件")
+            print(f"  素の dict : {legacy_size:>12,} bytes  保存 {legacy_save:5.2f}s  読込 {legacy_load:5.2f}s")
+            print(f"  列指向    : {size:>12,} bytes  保存 {save:5.2f}s  読込 {load:5.2f}s  ({size / legacy_size:.0%})")
+
+    with _workdir():
+        records = make_image_records(100)
+        # schema 1（素の dict）からの移行
+        main._save_json(main.IMAGE_RECORDS_FILE, records)
+        if main.load_image_records() != records:
+            raise AssertionError("schema 1 のファイルを読めません")
+        main.save_image_records(main.load_image_records())
+        if main._load_json(main.IMAGE_RECORDS_FILE, {}).get("schema") != main.IMAGE_RECORDS_SCHEMA:
+            raise AssertionError("保存時に新形式へ移行されていません")
+
+        # 書き込み途中で落ちても元のファイルが残ること
+        before = open(main.IMAGE_RECORDS_FILE, "rb").read()
+        original = os.replace
+
+        def crash(*args):
+            raise KeyboardInterrupt
+
+        os.replace = crash  # 一時ファイルを書き終えて置き換える直前に落ちる
+        try:
+            main.save_image_records(records)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.replace = original
+        if open(main.IMAGE_RECORDS_FILE, "rb").read() != before or glob.glob(f"{main.CACHE_DIR}/*.tmp"):
+            raise AssertionError("保存中の中断でキャッシュが壊れました")
+    print("✅ 往復一致 / schema 1 から移行 / 保存中断でも元のファイルを保持")
+
+
+# ===========================
+# 途中で止まったコールドビルドの再開
+# ===========================
+def bench_checkpoint(n_images=200, stop_after=120, every=25):
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+
+    routes = {f"/img/{i:05d}.jpg": jpeg for i in range(n_images)}
+    main.EXIF_HOST_RATE = 0
+    main.THUMB_WIDTHS = (200,)
+    main.CHECKPOINT_EVERY = every
+    main.CHECKPOINT_SECONDS = 3600  # 枚数だけで区切って結果を決定的にする
+
+    with StandInServer(routes) as server, _workdir():
+        entries = [{"alt": "bench", "src": server.base_url + p} for p in routes]
+
+        # 中断なしの基準
+        t0 = time.perf_counter()
+        expected = _quiet(main.build_image_records, entries, {}, workers=4)
+        full = time.perf_counter() - t0
+        shutil.rmtree(main.THUMBS_DIR)
+        os.remove(main.IMAGE_JOURNAL_FILE)
+        server.reset()
+
+        # stop_after 枚目の処理中にジョブが止まったことにする
+        original = main.process_image
+        calls = [0]
+
+        def interrupted(src, data):
+            calls[0] += 1
+            if calls[0] > stop_after:
+                raise KeyboardInterrupt
+            return original(src, data)
+
+        main.process_image = interrupted
+        try:
+            _quiet(main.build_image_records, entries, main.load_image_records(), workers=4)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            main.process_image = original
+        first_requests = sum(server.requests.values())
+
+        # 次のジョブ：ジャーナルから復元して残りだけ取る
+        server.reset()
+        records = _quiet(main.load_image_records)
+        journaled = len(records)
+        t0 = time.perf_counter()
+        records = _quiet(main.build_image_records, entries, records, workers=4)
+        resume = time.perf_counter() - t0
+        done = {src[len(server.base_url):] for src in list(records)[:journaled]}
+        refetched = sum(1 for p in done if server.requests.get(p))
+        second_requests = sum(server.requests.values())
+        main.save_image_records(records)
+
+        print(f"📊 {n_images} 枚 / {stop_after} 枚目の後で中断 / {every} 枚ごとにチェックポイント")
+        print(f"  中断前に取得     : {first_requests:>4} リクエスト")
+        print(f"  ジャーナルから復元: {journaled:>4} 件")
+        print(f"  再開後に取得     : {second_requests:>4} リクエスト  (再取得 {refetched} 件)")
+        print(f"  中断なし {full:5.2f}s / 再開分 {resume:5.2f}s")
+
+        if journaled < stop_after - stop_after % every or journaled > stop_after:
+            raise AssertionError(f"チェックポイント済みの件数がおかしい: {journaled}")
+        if refetched or second_requests != n_images - journaled:
+            raise AssertionError("ジャーナルに残った画像をもう一度取得しました")
+        if os.path.exists(main.IMAGE_JOURNAL_FILE):
+            raise AssertionError("保存後にジャーナルが残っています")
+        if _without_checked(main.load_image_records()) != _without_checked(expected):
+            raise AssertionError("再開後のレコードが中断なしの結果と一致しません")
+
+        # 追記途中で切れた最終行は読み飛ばす
+        journal = main.RecordJournal(every=1)
+        _quiet(journal.append, "a", {"exif": {}})
+        with open(main.IMAGE_JOURNAL_FILE, "a", encoding="utf-8") as f:
+            f.write('["b",{"exif":')
+        restored = {}
+        _quiet(main.replay_journal, restored)
+        if list(restored) != ["a"]:
+            raise AssertionError("壊れた最終行でジャーナルの再生に失敗しました")
+
+        # 多バイト文字の途中で切れた行（「レンズ」の途中）も読み飛ばし、続きの追記は別の行になる
+        torn = '\n["c",{"exif":{"lens":"レンズ"}}]'.encode("utf-8")
+        with open(main.IMAGE_JOURNAL_FILE, "ab") as f:
+            f.write(torn[:torn.index("ズ".encode("utf-8")) + 1])
+        _quiet(journal.append, "d", {"exif": {}})
+        restored = {}
+        _quiet(main.replay_journal, restored)
+        if list(restored) != ["a", "d"]:
+            raise AssertionError(f"文字の途中で切れた行でジャーナルの再生に失敗しました: {list(restored)}")
+    print("✅ 中断地点から再開 / 再取得ゼロ / 保存でジャーナルを畳む / 壊れた行（文字の途中で切れた行も）を無視")
+
+
+# ===========================
+# APP1 リーダーと piexif.load の一致・速度
+# ===========================
+def _piexif_reference(data):
+    """変更前の抽出（piexif.load で全 IFD を読む）"""
+    try:
+        exif_dict = piexif.load(data)
+    except Exception:
+        return {}
+    return main.exif_fields(exif_dict.get("0th", {}), exif_dict.get("Exif", {}))
+
+
+def _exif_corpus():
+    """(名前, バイト列, piexif が読めず新リーダーだけが読む想定か) のリスト"""
+    from PIL import Image
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        sample = f.read()
+    _, (start, end) = main._locate_exif_segment(sample)
+
+    def jpeg(exif=None, fmt="JPEG"):
+        buf = io.BytesIO()
+        kwargs = {"exif": exif} if exif is not None else {}
+        Image.new("RGB", (64, 48), (120, 90, 60)).save(buf, fmt, **kwargs)
+        return buf.getvalue()
+
+    def dump(zeroth, exif=None, **extra):
+        return piexif.dump({"0th": zeroth, "Exif": exif or {}, **extra})
+
+    I, E = piexif.ImageIFD, piexif.ExifIFD
+    full = {
+        E.LensModel: b"LUMIX G VARIO 12-60/F3.5-5.6",
+        E.ISOSpeedRatings: 3200,
+        E.FNumber: (56, 10),
+        E.ExposureTime: (1, 250),
+        E.FocalLength: (427, 10),
+        E.DateTimeOriginal: b"2024:06:01 05:43:21",
+    }
+    big = dump({I.Model: b"DC-G99"}, full)
+
+    # Pillow は little-endian で書く
+    le = Image.Exif()
+    le[I.Model] = "OM-1"
+    le.get_ifd(I.ExifTag).update({
+        E.LensModel: "M.Zuiko 60mm Macro", E.ISOSpeedRatings: 200,
+        E.FNumber: 8.0, E.ExposureTime: 0.004, E.FocalLength: 60.0,
+        E.DateTimeOriginal: "2023:09:30 11:00:00",
+    })
+
+    thumb = jpeg()
+    with_gps = dump(
+        {I.Model: b"TG-7"}, full,
+        GPS={piexif.GPSIFD.GPSLatitudeRef: b"N", piexif.GPSIFD.GPSLatitude: ((35, 1), (40, 1), (0, 1))},
+        **{"1st": {I.Compression: 6}, "thumbnail": thumb},
+    )
+
+    app0 = b"\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    xmp_body = b"http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>"
+    xmp = b"\xff\xe1" + (len(xmp_body) + 2).to_bytes(2, "big") + xmp_body
+    big_jpeg = jpeg(big)
+
+    # GPS IFD のポインタを範囲外に壊す（piexif は全体を諦める）
+    broken_gps = bytearray(with_gps)
+    tiff = 6
+    pos = broken_gps.index(I.GPSTag.to_bytes(2, "big"), tiff + 8)
+    broken_gps[pos + 8:pos + 12] = (0x7FFFFFF0).to_bytes(4, "big")
+
+    return [
+        ("exif-test.jpg", sample, False),
+        ("exif-test APP1 のみ", sample[start:end], False),
+        ("big-endian 全タグ", big_jpeg, False),
+        ("little-endian（Pillow）", jpeg(le.tobytes()), False),
+        ("EXIF 無し", jpeg(), False),
+        ("0th のみ（Exif IFD 無し）", jpeg(dump({I.Model: b"QV-10"})), False),
+        ("ISO は ISOSpeed だけ", jpeg(dump({I.Model: b"Z 9"}, {E.ISOSpeed: 64000})), False),
+        ("ISO が複数値", jpeg(dump({I.Model: b"Z 9"}, {E.ISOSpeedRatings: (400, 800)})), False),
+        ("4 バイト以内の ASCII", jpeg(dump({I.Model: b"E1"}, {E.LensModel: b"X"})), False),
+        ("端数の焦点距離・長秒", jpeg(dump({I.Model: b"K-3"}, {E.FocalLength: (183, 10), E.ExposureTime: (30, 1)})), False),
+        ("GPS・サムネイル付き", jpeg(with_gps), False),
+        ("APP0・XMP の後に Exif", b"\xff\xd8" + app0 + xmp + big_jpeg[2:], False),
+        ("TIFF ヘッダーから", big[6:], False),
+        ("APP1 の途中で途切れ", big_jpeg[:40], False),
+        ("PNG", jpeg(fmt="PNG"), False),
+        ("WebP（piexif に委譲）", jpeg(big, fmt="WEBP"), False),
+        ("マーカー前のフィルバイト", b"\xff\xd8\xff" + big_jpeg[2:], True),
+        ("壊れた GPS ポインタ", jpeg(bytes(broken_gps)), True),
+    ]
+
+
+def bench_exif_reader(rounds=2000):
+    failures = []
+    print("📊 piexif.load との一致")
+    for label, data, lenient in _exif_corpus():
+        got = main.extract_exif_from_bytes(data)
+        ref = _piexif_reference(data)
+        if lenient:
+            # piexif は読めないが、新リーダーは必要な IFD だけ見るので読める
+            ok = ref == {} and bool(got.get("model"))
+            verdict = "✅ 新リーダーのみ読める" if ok else "❌"
+        else:
+            ok = got == ref
+            verdict = "✅" if ok else "❌"
+        print(f"  {verdict} {label}: {got.get('model') or '-'} / {got.get('date') or '-'}")
+        if not ok:
+            failures.append((label, got, ref))
+    if failures:
+        for label, got, ref in failures:
+            print(f"  {label}\n    新: {got}\n    旧: {ref}")
+        raise AssertionError(f"{len(failures)} 件が piexif と一致しません")
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        sample = f.read()
+    _, (start, end) = main._locate_exif_segment(sample)
+    print(f"📊 1 枚あたりの抽出時間（{rounds} 回平均）")
+    for label, data in (("画像全体", sample), ("APP1 のみ", sample[start:end])):
+        timings = []
+        for func in (_piexif_reference, main.extract_exif_from_bytes):
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                func(data)
+            timings.append((time.perf_counter() - t0) / rounds * 1e6)
+        print(f"  {label:<6} ({len(data):>9,} bytes): piexif {timings[0]:7.1f}µs → 新 {timings[1]:6.1f}µs  "
+              f"(×{timings[0] / timings[1]:.1f})")
+
+
+# ===========================
+# ローカル原本からの取り込み
+# ===========================
+def bench_local_ingest(n_images=48, latency=0.05):
+    from urllib.parse import quote
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+
+    # はてなフォトライフ風の URL。一部は縮小プロキシ経由で元 URL が埋め込まれている
+    paths = [f"/images/fotolife/b/bench/20250914/20250914{i:06d}.jpg" for i in range(n_images)]
+    main.EXIF_HOST_RATE = 0
+    main.THUMB_WIDTHS = (200, 400)
+
+    with _workdir() as tmp:
+        originals = os.path.join(tmp, "originals")
+        os.makedirs(os.path.join(originals, "2025"))
+        for i, p in enumerate(paths[:-2]):
+            name = os.path.basename(p)
+            if i % 3 == 0:
+                name = name.replace(".jpg", ".JPG")  # 大文字の拡張子でも当たる
+            with open(os.path.join(originals, "2025", name), "wb") as f:
+                f.write(jpeg)
+        # 名前の合わない 1 枚は対応表で指定する
+        with open(os.path.join(originals, "P1010001.JPG"), "wb") as f:
+            f.write(jpeg)
+
+        with StandInServer({p: jpeg for p in paths}, latency=latency) as server:
+            def src_of(i, p):
+                url = server.base_url + p
+                if i % 4 == 1:
+                    return server.base_url + "/image/scale/abc/width=1300/" + quote(url, safe="")
+                return url
+
+            entries = [{"alt": "bench", "src": src_of(i, p)} for i, p in enumerate(paths)]
+            manifest = os.path.join(tmp, "local-images.json")
+            main._save_json(manifest, {entries[-2]["src"]: "originals/P1010001.JPG"})
+            for e in entries:
+                server.routes[e["src"][len(server.base_url):]] = jpeg
+
+            # 従来どおりネットから取る
+            t0 = time.perf_counter()
+            remote = _quiet(main.build_image_records, entries, {}, workers=8)
+            remote_time = time.perf_counter() - t0
+            shutil.rmtree(main.THUMBS_DIR)
+            server.reset()
+
+            main.LOCAL_IMAGES_DIR = originals
+            main.LOCAL_IMAGES_MANIFEST = manifest
+            resolved = main.resolve_local_images([e["src"] for e in entries])
+            t0 = time.perf_counter()
+            local = _quiet(main.build_image_records, entries, {}, workers=8)
+            local_time = time.perf_counter() - t0
+            fetched = sum(server.requests.values())
+
+            # オフライン：ローカルに無い 1 枚は取りに行かず未処理で残す
+            shutil.rmtree(main.THUMBS_DIR)
+            server.reset()
+            main.LOCAL_IMAGES_ONLY = True
+            offline = _quiet(main.build_image_records, entries, {}, workers=8)
+            offline_requests = sum(server.requests.values())
+
+            # EXIF だけ（mmap で APP1 のページしか触らない）
+            main.THUMB_WIDTHS = ()
+            t0 = time.perf_counter()
+            exif_only = _quiet(main.build_image_records, entries, {}, workers=8)
+            exif_time = time.perf_counter() - t0
+            main.LOCAL_IMAGES_ONLY = False
+            main.LOCAL_IMAGES_DIR = main.LOCAL_IMAGES_MANIFEST = ""
+
+    print(f"📊 {n_images} 枚 / 遅延 {latency * 1000:.0f}ms / 画像 {len(jpeg):,} bytes")
+    print(f"  ローカルで見つかった: {len(resolved)} 件（対応表 1 件を含む）")
+    print(f"  ネット取得          : {remote_time:6.2f}s")
+    print(f"  ローカル原本 + 残り  : {local_time:6.2f}s  ネット {fetched} リクエスト")
+    print(f"  EXIF のみ（オフライン）: {exif_time * 1000:6.1f}ms")
+
+    if len(resolved) != n_images - 1:
+        raise AssertionError(f"ローカル原本の突き合わせ件数がおかしい: {len(resolved)}")
+    if _without_checked(local) != _without_checked(remote):
+        raise AssertionError("ローカル原本とネット取得でレコードが一致しません")
+    if fetched != 1:
+        raise AssertionError("ローカルにある画像までネットから取得しました")
+    if offline_requests or len(offline) != n_images - 1 or len(exif_only) != n_images - 1:
+        raise AssertionError("オフラインモードでネットに出ました")
+    if any(exif_only[src]["exif"] != remote[src]["exif"] for src in exif_only):
+        raise AssertionError("EXIF のみの読み込み結果が一致しません")
+
+    # 日付フォルダごとに同じカメラのファイル名がある：どちらとも決めず、対応表があればそれに従う
+    with _workdir() as tmp:
+        for day in ("20250913", "20250914"):
+            os.makedirs(os.path.join(tmp, "dcim", day))
+            with open(os.path.join(tmp, "dcim", day, "IMG_0001.JPG"), "wb") as f:
+                f.write(jpeg)
+        src = "https://cdn-ak.f.st-hatena.com/images/fotolife/b/bench/20250914/IMG_0001.jpg"
+        guessed = _quiet(main.resolve_local_images, [src], root=os.path.join(tmp, "dcim"), manifest="")
+        manifest = os.path.join(tmp, "local-images.json")
+        main._save_json(manifest, {src: "dcim/20250914/IMG_0001.JPG"})
+        mapped = _quiet(main.resolve_local_images, [src], root=os.path.join(tmp, "dcim"), manifest=manifest)
+        print(f"  同名ファイル 2 件: 名前だけでは {len(guessed)} 件 / 対応表で {len(mapped)} 件")
+        if guessed or mapped.get(src, "").split(os.sep)[-2:] != ["20250914", "IMG_0001.JPG"]:
+            raise AssertionError(f"同名のローカル原本を取り違えました: {guessed} / {mapped}")
+    print("✅ ネット取得と同じレコード / ローカルにある画像は取得しない / オフラインで完結 / 同名ファイルは推測しない")
+
+
+# ===========================
+# 取得失敗の再試行（指数バックオフと予算）
+# ===========================
+def bench_retry_policy(n_failing=6, budget=4):
+    from PIL import Image
+
+    with open(SAMPLE_JPEG, "rb") as f:
+        jpeg = f.read()
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 32)).save(buf, "JPEG")
+    plain = buf.getvalue()
+
+    main.EXIF_HOST_RATE = 0
+    main.THUMB_WIDTHS = ()
+    main.HTTP_RETRIES = 0
+    main.HTTP_TIMEOUT = 0.3
+    main.RETRY_BUDGET = budget
+    base = main.RETRY_BASE_SECONDS
+
+    routes = {"/ok.jpg": jpeg, "/plain.jpg": plain}
+    missing = [f"/missing/{i}.jpg" for i in range(n_failing)]
+    with StandInServer(routes) as server, StandInServer({"/slow.jpg": jpeg}, latency=1.0) as slow, _workdir():
+        entries = [{"alt": "bench", "src": server.base_url + p} for p in ["/ok.jpg", "/plain.jpg"] + missing]
+        entries.append({"alt": "bench", "src": slow.base_url + "/slow.jpg"})
+        # 予算より多い status 導入前のレコード（予算に関係なく普通に処理し直す）
+        legacies = [f"/legacy/{i}.jpg" for i in range(budget + 2)]
+        for p in legacies:
+            routes[p] = jpeg
+            entries.append({"alt": "bench", "src": server.base_url + p})
+
+        def run(records):
+            # 取得し直した画像の数（レコードが差し替わった件数）
+            before = dict(records)
+            records = _quiet(main.build_image_records, entries, records, workers=4)
+            return records, sum(1 for src, r in records.items() if before.get(src) is not r)
+
+        def age(records, seconds):
+            # 実行の間に時間が経ったことにする
+            for r in records.values():
+                r["checked"] = r.get("checked", 0) - seconds
+
+        def statuses(records):
+            counts = {}
+            for r in records.values():
+                counts[r.get("status")] = counts.get(r.get("status"), 0) + 1
+            return counts
+
+        # status 導入前の「失敗して {} が残った」レコード
+        records = {server.base_url + p: {"exif": {}} for p in legacies}
+        records, first = run(records)
+        print(f"📊 初回: {first} 件取得  {statuses(records)}")
+        if any(records[server.base_url + p]["status"] != "ok" for p in ["/ok.jpg"] + legacies):
+            raise AssertionError("EXIF のある画像（status 導入前のレコードを含む）が ok になっていません")
+        if records[server.base_url + "/plain.jpg"]["status"] != "no-exif":
+            raise AssertionError("EXIF の無い画像が no-exif になっていません")
+        if records[slow.base_url + "/slow.jpg"]["status"] != "timeout":
+            raise AssertionError("タイムアウトが記録されていません")
+        if statuses(records).get("http-error") != n_failing:
+            raise AssertionError("HTTP エラーが記録されていません")
+
+        records, second = run(records)
+        print(f"  直後の再実行: {second} 件取得（バックオフ中）")
+        if second:
+            raise AssertionError("バックオフ中に取り直しました")
+
+        age(records, base)
+        records, third = run(records)
+        twice = {src for src, r in records.items() if r.get("attempts") == 2}
+        print(f"  {base / 3600:.0f} 時間後: {third} 件取得 / 再試行 {len(twice)} 件（予算 {budget}）")
+        if third != budget or len(twice) != budget:
+            raise AssertionError("再試行が予算どおりになっていません")
+
+        # 2 回失敗した分は待ちが倍になるので、残りの 1 回目の失敗だけを取る
+        age(records, base)
+        once = {src for src, r in records.items() if r.get("attempts") == 1}
+        records, fourth = run(records)
+        print(f"  さらに {base / 3600:.0f} 時間後: {fourth} 件取得（1 回目の失敗 {len(once)} 件だけ）")
+        if fourth != len(once) or any(records[src]["attempts"] != 2 for src in twice):
+            raise AssertionError(f"指数バックオフが効いていません: {fourth}")
+
+        # サーバーが直ったら次の再試行で ok になる
+        for p in missing:
+            routes[p] = jpeg
+        age(records, base * 4)
+        records, fifth = run(records)
+        records, _ = run(records)
+        age(records, base * 8)
+        records, _ = run(records)
+        print(f"  復旧後: {statuses(records)}")
+        if statuses(records).get("http-error"):
+            raise AssertionError("復旧後も失敗のまま残っています")
+
+    # EXIF は読めるが画像として壊れている：EXIF を残し、取り直さない
+    _, (_, app1_end) = main._locate_exif_segment(jpeg)
+    broken = jpeg[:app1_end] + b"\xff\xd9"
+    main.THUMB_WIDTHS = (200,)
+    with StandInServer({"/broken.jpg": broken}) as server, _workdir():
+        entries = [{"alt": "bench", "src": server.base_url + "/broken.jpg"}]
+        records = _quiet(main.build_image_records, entries, {}, workers=1)
+        record = records[entries[0]["src"]]
+        print(f"  画像が壊れている: status={record['status']} EXIF {record['exif'].get('model')} / {record.get('image_error')}")
+        if record["status"] != "ok" or not record["exif"].get("model") or record["widths"]:
+            raise AssertionError("画像処理の失敗で EXIF が失われました")
+        for r in records.values():
+            r["checked"] -= main.RETRY_MAX_SECONDS
+        server.reset()
+        _quiet(main.build_image_records, entries, records, workers=1)
+        if sum(server.requests.values()):
+            raise AssertionError("取り直しても変わらない失敗を再取得しました")
+    print("✅ 状態を区別して記録 / バックオフ中は取らない / 予算内で古い失敗から再試行 / 復旧で ok")
+    print("✅ status 導入前のレコードは予算外で処理 / 画像だけ壊れていても EXIF を残し再取得しない")
+
+
+# ===========================
+# ビルド工程の計測レポート
+# ===========================
+def bench_build_report(n_articles=113):
+    main.THUMB_WIDTHS = ()
+    with _workdir():
+        entries, _ = _fixture_entries(n_articles)
+        os.remove(main.IMAGES_CACHE_FILE)  # 記事の解析も初回から
+
+        def build():
+            main.BUILD_STAGES.clear()
+            with main.build_stage("extract"):
+                found = _quiet(main.fetch_images, workers=1)
+            with main.build_stage("images"):
+                images = _quiet(main.build_image_records, found, main.load_image_records())
+                _quiet(main.save_image_records, images)
+            exif_cache = main.exif_view(images)
+            with main.build_stage("gallery"):
+                grouped = _quiet(main.generate_gallery, found, exif_cache, images)
+            with main.build_stage("index"):
+                _quiet(main.generate_index, grouped, exif_cache, images)
+            with main.build_stage("favorite"):
+                _quiet(main.generate_favorite_page, grouped, exif_cache)
+            main.write_build_report()
+            with open(main.BUILD_REPORT_FILE, encoding="utf-8") as f:
+                return {s["name"]: s for s in json.load(f)["stages"]}
+
+        print("📊 初回")
+        cold = build()
+        print("📊 変更なしで再実行（前回との差つき）")
+        warm = build()
+
+    if [s for s in cold] != ["extract", "images", "gallery", "index", "favorite"]:
+        raise AssertionError("工程がレポートに揃っていません")
+    if cold["extract"]["counters"]["cache_hits"] or not warm["extract"]["counters"]["cache_hits"]:
+        raise AssertionError("解析キャッシュのヒット数が記録されていません")
+    if warm["images"]["counters"]["cache_hits"] != len({e["src"] for e in entries}):
+        raise AssertionError("画像レコードのヒット数が記録されていません")
+    written = cold["gallery"]["counters"]
+    if not written.get("pages_written") or warm["gallery"]["counters"].get("pages_written"):
+        raise AssertionError("ページの書き込み数が記録されていません")
+    if written["files_written"] < written["pages_written"] or not written["bytes_written"]:
+        raise AssertionError("書き込みバイト数が記録されていません")
+    print("✅ 工程ごとの時間・キャッシュ・ページ・書き込み量を JSON と要約に出力")
+
+
+# ===========================
+# 合成ブログでのパイプライン全体（規模別・結果を記録して回帰を検出）
+# ===========================
+# 名前 → (記事数, 画像数)
+PIPELINE_SCALES = {
+    "small": (100, 1_000),
+    "medium": (1_000, 50_000),
+    "large": (10_000, 50_000),
+}
+RESULTS_FILE = os.path.join(REPO_DIR, "benchmarks", "results.jsonl")
+# 前回の記録よりこれだけ遅く、かつ差が REGRESSION_MIN_SECONDS 以上なら回帰とみなす
+REGRESSION_RATIO = 1.25
+REGRESSION_MIN_SECONDS = 0.2
+
+
+def make_exif_jpegs(n=8, size=(320, 240)):
+    """EXIF 付きの小さな JPEG を n 種類作る（画像の中身は配信の負荷にしか関わらない）"""
+    from PIL import Image
+
+    I, E = piexif.ImageIFD, piexif.ExifIFD
+    jpegs = []
+    for i in range(n):
+        exif = piexif.dump({"0th": {I.Model: f"Bench-{i}".encode()}, "Exif": {
+            E.LensModel: b"Macro 60mm", E.ISOSpeedRatings: 100 * (i + 1), E.FNumber: (28 + i, 10),
+            E.ExposureTime: (1, 60 + i), E.FocalLength: (60, 1),
+            E.DateTimeOriginal: f"2024:{i % 12 + 1:02d}:{i + 1:02d} 10:00:00".encode(),
+        }})
+        buf = io.BytesIO()
+        Image.new("RGB", size, (40 + i * 20, 90, 60)).save(buf, "JPEG", quality=70, exif=exif)
+        jpegs.append(buf.getvalue())
+    return jpegs
+
+
+def make_blog(n_articles, n_images, seed=0):
+    """はてなブログ風の合成記事を作る。
+
+    戻り値: (Atom 用 entries（新しい順）, 画像パス → テンプレート番号)
+    画像は 1 枚ずつ別 URL で、キノコ名は画像 25 枚あたり 1 種類。
+    """
+
+    rng = random.Random(seed)
+    names = make_mushroom_names(max(20, n_images // 25), seed=seed)
+    start = datetime(2020, 1, 1, tzinfo=timezone(timedelta(hours=9)))
+    images = {}
+    entries = []
+    for a in range(n_articles):
+        # 画像を記事に均等に割り振る（端数は先頭の記事に）
+        count = n_images // n_articles + (1 if a < n_images % n_articles else 0)
+        ts = start + timedelta(hours=a)
+        body = [f"<p>{ts:%Y年%m月%d日}の観察記録です。</p>"]
+        for _ in range(count):
+            path = f"/images/fotolife/b/bench/{ts:%Y%m%d}/{ts:%Y%m%d}{len(images):06d}.jpg"
+            images[path] = len(images) % 8
+            name = rng.choice(names)
+            body.append(
+                f'<p><span itemscope itemtype="http://schema.org/Photograph">'
+                f'<img src="{{base}}{path}" alt="{name}" title="" class="hatena-fotolife" itemprop="image">'
+                f"</span></p><p>{name}を見つけました。傘の裏はひだ状。</p>"
+            )
+        # 除外対象（ブックマークボタンや関連記事の埋め込み）も混ぜる
+        body.append('<a href="https://b.hatena.ne.jp/entry/"><img src="https://b.st-hatena.com/b.png" alt="はてなブックマーク"></a>')
+        body.append(f'<iframe title="キノコと田舎遊び {a}" src="https://example.invalid/embed"></iframe>')
+        entries.append({
+            "id": f"tag:blog.hatena.ne.jp,2013:blog-bench-6802418398336734667-{10 ** 17 + a}",
+            "title": f"観察記録 {a}",
+            "categories": ["キノコ"],
+            "edited": ts.isoformat(),
+            "content": '<div class="entry-body">' + "".join(body) + "</div>",
+        })
+    entries.reverse()
+    return entries, images
+
+
+def _git_revision():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(git("status", "--porcelain", "--", "main.py"))
+
+
+def _run_pipeline():
+    """main.run_build()（__main__ と同じ全工程）を回し、工程名 → 工程の dict を返す"""
+    main.BUILD_STAGES.clear()
+    entries = _quiet(main.run_build)
+    return {stage["name"]: stage for stage in main.BUILD_STAGES}, len(entries)
+
+
+def _host_identity():
+    """記録したマシンを見分けるための情報（別マシンの記録とは比べない）"""
+    return {
+        "node": platform.node(),
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def _previous_result(scale, run, commit, host):
+    """同じマシン・同じ設定・同じ規模・同じ実行種別の、別コミットでの直近の記録"""
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    previous = None
+    with open(RESULTS_FILE, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if (row.get("host") == host and row.get("thumb_widths") == list(main.THUMB_WIDTHS)
+                    and row.get("scale") == scale and row.get("run") == run and row.get("commit") != commit):
+                previous = row
+    return previous
+
+
+def bench_pipeline(*scales, latency=0.0, record=True):
+    """python benchmark.py pipeline [small|medium|large ...]（既定は small）
+
+    サムネイル生成も含めて本番と同じ設定（THUMB_WIDTHS）で回す。
+    記録はマシンごとの値なので benchmarks/results.jsonl はコミットしない。
+    """
+    scales = scales or ("small",)
+    unknown = [s for s in scales if s not in PIPELINE_SCALES]
+    if unknown:
+        raise SystemExit(f"規模は {', '.join(PIPELINE_SCALES)} から選んでください: {unknown}")
+
+    commit, dirty = _git_revision()
+    host = _host_identity()
+    jpegs = make_exif_jpegs()
+    main.EXIF_HOST_RATE = 0
+    main.EXIF_WORKERS = 16
+    regressions = []
+
+    for scale in scales:
+        n_articles, n_images = PIPELINE_SCALES[scale]
+        feed, image_paths = make_blog(n_articles, n_images)
+        with StandInServer({}, latency=latency, content_type=None) as server, _workdir():
+            routes = {}
+            for url, body in make_atom_routes(feed).items():
+                routes[url] = body.replace("{base}", server.base_url).encode("utf-8")
+            routes.update({p: jpegs[t] for p, t in image_paths.items()})
+            server.routes = routes
+            main.ATOM_ENDPOINT = server.base_url + "/atom/entry"
+            main.set_http_session(None)
+
+            print(f"📊 {scale}: {n_articles:,} 記事 / {n_images:,} 枚（サムネイル {', '.join(map(str, main.THUMB_WIDTHS)) or 'なし'}）")
+            for run in ("cold", "warm"):
+                stages, found = _run_pipeline()
+                if found != n_images:
+                    raise AssertionError(f"画像の検出数が合いません: {found} / {n_images}")
+                total = sum(s["seconds"] for s in stages.values())
+                print(f"  {'初回' if run == 'cold' else '変更なし'}（合計 {total:.2f}s）")
+                previous = _previous_result(scale, run, commit, host)
+                for name, stage in stages.items():
+                    line = main._format_stage(stage)
+                    before = previous and previous["stages"].get(name)
+                    if before is not None:
+                        line += f"  前回 {before:.2f}s"
+                        if stage["seconds"] > before * REGRESSION_RATIO and stage["seconds"] - before >= REGRESSION_MIN_SECONDS:
+                            line += "  ⚠️ 回帰の疑い"
+                            regressions.append((scale, run, name, before, stage["seconds"]))
+                    print(f"    {line}")
+
+                if record:
+                    row = {
+                        "date": datetime.now().astimezone().isoformat(timespec="seconds"),
+                        "commit": commit,
+                        "dirty": dirty,
+                        "host": host,
+                        "thumb_widths": list(main.THUMB_WIDTHS),
+                        "scale": scale,
+                        "run": run,
+                        "articles": n_articles,
+                        "images": n_images,
+                        "stages": {name: s["seconds"] for name, s in stages.items()},
+                        "counters": {name: {**s["http"], **s["counters"]} for name, s in stages.items()},
+                    }
+                    os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+                    with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+            # 2 回目は何も取り直さず、ページも書かない
+            if stages["images"]["http"]["requests"] or stages["gallery"]["counters"].get("pages_written"):
+                raise AssertionError("変更なしの再実行で取得・書き込みが発生しました")
+        main.set_http_session(None)
+
+    if record:
+        print(f"📝 {os.path.relpath(RESULTS_FILE, REPO_DIR)} に記録（{commit}{' +変更あり' if dirty else ''} / {host['node']}）")
+    if regressions:
+        for scale, run, name, before, now in regressions:
+            print(f"⚠️ {scale}/{run}/{name}: {before:.2f}s → {now:.2f}s")
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    "exif-fetch": bench_exif_fetch,
+    "range-fetch": bench_range_fetch,
+    "http-session": bench_http_session,
+    "atom-sync": bench_atom_sync,
+    "extract-images": bench_extract_images,
+    "exclude-filter": bench_exclude_filter,
+    "parallel-extract": bench_parallel_extract,
+    "asset-size": bench_asset_size,
+    "incremental-output": bench_incremental_output,
+    "image-pass": bench_image_pass,
+    "exif-reader": bench_exif_reader,
+    "local-ingest": bench_local_ingest,
+    "retry-policy": bench_retry_policy,
+    "build-report": bench_build_report,
+    "layout-metrics": bench_layout_metrics,
+    "search-index": bench_search_index,
+    "search-keys": bench_search_keys,
+    "favorite-meta": bench_favorite_meta,
+    "image-records": bench_image_records,
+    "checkpoint": bench_checkpoint,
+    "pipeline": bench_pipeline,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("使い方: python benchmark.py <name>")
+        for name in BENCHMARKS:
+            print(f"  {name}")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -2,11 +2,26 @@ import os
 import glob
 import json
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
 import re
 import html
+from html.parser import HTMLParser
+import io
+import math
+import mmap
+import struct
+import unicodedata
+import base64
+import time
+import hashlib
+import threading
+import contextlib
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit, unquote
 import piexif
+from PIL import Image, ImageOps
 
 # ===========================
 # 珍しい / 人気キノコリスト（手動）
@@ -63,14 +78,127 @@ if not all([HATENA_USER, HATENA_BLOG_ID, HATENA_API_KEY]):
 ARTICLES_DIR = "articles"
 OUTPUT_DIR = "output"
 
-# ====== EXIF キャッシュ設定 ======
+# ====== HTTP 設定 ======
+# (接続, 読み込み) タイムアウト秒
+HTTP_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("HTTP_READ_TIMEOUT", "10")),
+)
+# 429 / 5xx / 接続エラー時のリトライ回数と指数バックオフの基準秒
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Retry-After で待つ秒数の上限（長すぎる指定でビルドが止まらないように）
+HTTP_RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", str(HTTP_TIMEOUT[1])))
+# ホストごとに保持する keep-alive 接続数
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# ====== 画像キャッシュ設定 ======
 CACHE_DIR = "cache"
+# 画像URL → 1枚分のレコード（EXIF・寸法・向き・知覚ハッシュ・サムネイル）
+IMAGE_RECORDS_FILE = os.path.join(CACHE_DIR, "image-records.json")
+# ファイル形式の版（2 = 列指向 + 文字列の辞書化。1 = URL → レコードの素の dict）
+IMAGE_RECORDS_SCHEMA = 2
+# レコードの中身を変えたら上げる（全画像をもう一度処理する）
+IMAGE_RECORD_REV = 1
+# 旧形式（URL → EXIF だけ）。初回に取り込む
 CACHE_FILE = os.path.join(CACHE_DIR, "exif-cache.json")
+# 処理済みレコードの追記ログ（途中で落ちても次回ここから再開し、保存時に本体へ畳む）
+IMAGE_JOURNAL_FILE = os.path.join(CACHE_DIR, "image-records.journal")
+# チェックポイントの間隔（何枚ごと / 何秒ごと。どちらか先に来た方でディスクへ書く）
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "50"))
+CHECKPOINT_SECONDS = float(os.getenv("CHECKPOINT_SECONDS", "30"))
+
+# ====== EXIF 並列取得設定 ======
+# 同時ダウンロード数（1 なら従来どおり逐次取得）
+EXIF_WORKERS = int(os.getenv("EXIF_WORKERS", "8"))
+# 1ホストあたりの最大リクエスト数/秒（0 なら無制限）
+EXIF_HOST_RATE = float(os.getenv("EXIF_HOST_RATE", "10"))
+# "range" = JPEG 先頭の APP1(Exif) だけ Range で取得 / "full" = 画像全体を取得
+EXIF_FETCH_MODE = os.getenv("EXIF_FETCH_MODE", "range")
+# Range 取得の初期ウィンドウ（APP1 がはみ出したら必要な分だけ追加で取る）
+EXIF_RANGE_BYTES = int(os.getenv("EXIF_RANGE_BYTES", "65536"))
+
+# ====== 取得失敗の再試行設定 ======
+# 失敗した画像を次に取り直すまでの待ち（秒）。失敗が続くたびに倍にし、上限で止める
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "3600"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", str(7 * 24 * 3600)))
+# 1 回の実行で取り直す失敗画像の上限（初めて見る画像は数えない）
+RETRY_BUDGET = int(os.getenv("RETRY_BUDGET", "50"))
+
+# ====== ビルド計測設定 ======
+# 工程ごとの時間・HTTP・キャッシュ・書き込み量の JSON（cache/ に置き、前回と比べる）
+BUILD_REPORT_FILE = os.getenv("BUILD_REPORT_FILE", os.path.join(CACHE_DIR, "build-report.json"))
+
+# ====== ローカル原本設定 ======
+# 元写真を置いたディレクトリ（ファイル名で src と突き合わせる。空なら使わない）
+LOCAL_IMAGES_DIR = os.getenv("LOCAL_IMAGES_DIR", "")
+# src → ローカルファイルの対応表（JSON。相対パスはこのファイルの場所から）
+LOCAL_IMAGES_MANIFEST = os.getenv("LOCAL_IMAGES_MANIFEST", "")
+# "1" ならローカルに無い画像も取りに行かない（オフラインでのビルド確認用）
+LOCAL_IMAGES_ONLY = os.getenv("LOCAL_IMAGES_ONLY", "0") == "1"
+
+# ====== サムネイル設定 ======
+# グリッド用に作る幅（空にするとサムネイル生成をやめ、EXIF は Range 取得だけになる）
+THUMB_WIDTHS = tuple(int(w) for w in os.getenv("THUMB_WIDTHS", "200,400,800").split(",") if w.strip())
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "80"))
+# グリッド 1 列の表示幅（PC は 900px / 4列、スマホは 3列）
+THUMB_SIZES = "(max-width: 580px) 34vw, 225px"
+THUMBS_DIR = os.path.join(OUTPUT_DIR, "thumbs")
+# 読み込み中に敷くプレースホルダー（インライン data URI）の幅
+LQIP_WIDTH = int(os.getenv("LQIP_WIDTH", "20"))
+
+# ====== 出力設定 ======
+# 出力ページ → 入力ハッシュ（同じなら書き直さない）
+OUTPUT_MANIFEST_FILE = os.path.join(CACHE_DIR, "output-manifest.json")
+# ページの HTML 組み立てを変えたら上げる（全ページを書き直す）
+GALLERY_TEMPLATE_REV = 6
+# 共通 CSS / JS の書き出し先（ファイル名に内容ハッシュを含める）
+ASSETS_DIR = os.path.join(OUTPUT_DIR, "assets")
+# 公開先の URL。gallery.js が index.html をブログに埋め込んでも CSS / JS が解決するよう絶対 URL で参照する
+SITE_BASE_URL = os.getenv("SITE_BASE_URL", "https://charchan123.github.io/hatena-photo-gallery/")
+# 横断検索のシャード（文字ごとに、その文字を含むキノコ名の一覧）
+SEARCH_DIR = os.path.join(OUTPUT_DIR, "search")
+# 観察ノート用の写真メタデータ（URL ハッシュの先頭 META_SHARD_HEX 桁ごとのシャード）
+META_DIR = os.path.join(OUTPUT_DIR, "meta")
+META_SHARD_HEX = int(os.getenv("META_SHARD_HEX", "2"))
+# 1 ならローマ字の検索キーも作る（"kinoko" で キノコ が引ける）
+SEARCH_ROMAJI = os.getenv("SEARCH_ROMAJI", "1") == "1"
+
+# ====== 記事同期設定 ======
+# entry id ごとの保存先・内容ハッシュ・メタデータ（タイトル/カテゴリ/公開日）
+ARTICLES_INDEX_FILE = os.path.join(CACHE_DIR, "articles-index.json")
+# 1 にすると manifest を無視して全ページを取り直す（復旧用）
+HATENA_FULL_RESYNC = os.getenv("HATENA_FULL_RESYNC") == "1"
+# 前回の全件同期からこの日数が過ぎたら自動で全件同期し、削除された記事を片付ける（0 以下で無効）
+HATENA_FULL_SYNC_DAYS = float(os.getenv("HATENA_FULL_SYNC_DAYS", "7"))
+
+# ====== 画像抽出設定 ======
+# 記事の内容ハッシュ → 抽出済み {alt, src} リスト
+IMAGES_CACHE_FILE = os.path.join(CACHE_DIR, "article-images-cache.json")
+# 抽出ロジックを変えたら上げる（キャッシュを作り直す）
+IMAGE_EXTRACTOR_REV = 2
+
+# 記事解析のプロセス数（0 = CPU コア数、1 = 逐次）と 1 ワーカーへ渡す記事数
+ARTICLE_WORKERS = int(os.getenv("ARTICLE_WORKERS", "0"))
+ARTICLE_BATCH_SIZE = int(os.getenv("ARTICLE_BATCH_SIZE", "32"))
+
+# iframe タイトル・リンク文字列・alt がこれに当たる画像は拾わない
+# EXCLUDE_PATTERNS_FILE（JSON の文字列配列）があればそちらを使う
+EXCLUDE_PATTERNS_FILE = os.getenv("EXCLUDE_PATTERNS_FILE", "exclude-patterns.json")
+EXCLUDE_PATTERNS = [
+    r'はてなブックマーク',
+    r'^\d{4}年',
+    r'^この記事をはてなブックマークに追加$',
+    r'^ワ行$',
+    r'キノコと田舎遊び',
+]
 
 # ====== API ======
 ATOM_ENDPOINT = f"https://blog.hatena.ne.jp/{HATENA_USER}/{HATENA_BLOG_ID}/atom/entry"
 AUTH = (HATENA_USER, HATENA_API_KEY)
 HEADERS = {}
+ATOM_NS = {"atom": "http://www.w3.org/2005/Atom", "app": "http://www.w3.org/2007/app"}
 
 AIUO_GROUPS = {
     "あ行": list("あいうえおアイウエオ"),
@@ -111,6 +239,19 @@ body {
   visibility: hidden;
 }
 
+.gallery picture {
+  display: block;
+}
+
+/* ===== LQIP：本画像が届くまで縮小版をぼかして敷く ===== */
+.has-lqip {
+  background-size: cover;
+  background-position: center;
+}
+.has-lqip.is-loaded {
+  background-image: none !important;
+}
+
 .gallery a.gallery-item{
   display: block;
   break-inside: avoid;
@@ -1261,6 +1402,35 @@ document.addEventListener("DOMContentLoaded", () => {
     return src ? src.replace(/\\?.*$/, "") : "";
   }
 
+  // =========================
+  // 検索キー（main.py の search_key / romaji_canon と同じ畳み方）
+  // =========================
+  const SMALL_KANA = {
+    "ァ": "ア", "ィ": "イ", "ゥ": "ウ", "ェ": "エ", "ォ": "オ", "ッ": "ツ",
+    "ャ": "ヤ", "ュ": "ユ", "ョ": "ヨ", "ヮ": "ワ", "ヵ": "カ", "ヶ": "ケ"
+  };
+  const ROMAJI_RULES = [
+    [/tch/g, "tty"], [/sh/g, "sy"], [/ch/g, "ty"], [/ts/g, "t"], [/j/g, "zy"], [/f/g, "h"],
+    [/syi/g, "si"], [/tyi/g, "ti"], [/zyi/g, "zi"], [/m(?=[bp])/g, "n"], [/nn/g, "n"],
+    [/[^a-z0-9]/g, ""]
+  ];
+
+  function searchKey(str) {
+    return str.normalize("NFKC").toLowerCase()
+      .replace(/[\u3041-\u3096\u309d\u309e]/g, c => String.fromCharCode(c.charCodeAt(0) + 0x60))
+      .replace(/ー/g, "")
+      .replace(/[ァィゥェォッャュョヮヵヶ]/g, c => SMALL_KANA[c]);
+  }
+
+  function romajiCanon(str) {
+    return ROMAJI_RULES.reduce((s, [re, to]) => s.replace(re, to), str.normalize("NFKC").toLowerCase());
+  }
+
+  // 英数字と区切りだけならローマ字として探す
+  function isRomajiQuery(q) {
+    return /^[a-z0-9' -]+$/.test(q.normalize("NFKC").toLowerCase());
+  }
+
   function highlight(text, q) {
     if (!q) return text;
     const escaped = escapeRegExp(q);
@@ -1868,6 +2038,23 @@ document.addEventListener("DOMContentLoaded", () => {
     if (typeof sendHeight === "function") sendHeight();
   })();
 
+// =========================
+// LQIP：本画像の読み込みが終わったら下地を外す
+// =========================
+document.querySelectorAll(".has-lqip").forEach(el => {
+  const img = el.querySelector("img");
+  if (!img) return;
+  const done = () => el.classList.add("is-loaded");
+  if (img.complete && img.naturalWidth) done();
+  else img.addEventListener("load", done, { once: true });
+});
+
+// =========================
+// 観察ノート：★の写真のメタデータを先に取りにいく
+// =========================
+const PHOTO_META = {};
+const favoriteMetaReady = loadFavoriteMeta();
+
 // =========================
 // ギャラリー処理（LightGallery）
 // .gallery / .favorite-gallery 両対応
@@ -1876,6 +2063,16 @@ const galleries = document.querySelectorAll(
   ".gallery, .favorite-gallery"
 );
 
+// 全画像に width / height があればレイアウトは確定している（画像の読み込みを待たなくてよい）
+function isSizedGallery(gallery) {
+  const imgs = [...gallery.querySelectorAll("img")];
+  return (
+    gallery.classList.contains("gallery") &&
+    imgs.length > 0 &&
+    imgs.every(img => img.getAttribute("width") && img.getAttribute("height"))
+  );
+}
+
 galleries.forEach(gallery => {
 
   // =========================
@@ -1895,7 +2092,11 @@ galleries.forEach(gallery => {
     gallery.querySelectorAll("img").forEach(img => fadeObs.observe(img));
   }
 
-  imagesLoaded(gallery, () => {
+  const whenLaidOut = isSizedGallery(gallery)
+    ? fn => fn()
+    : fn => favoriteMetaReady.then(() => imagesLoaded(gallery, fn));
+
+  whenLaidOut(() => {
     gallery.style.visibility = "visible";
 
     // 初期同期
@@ -2053,11 +2254,11 @@ galleries.forEach(gallery => {
 
     function applyFilter() {
       const q = searchInput.value.trim();
-      const keyword = q ? q.normalize("NFKC").toLowerCase() : "";
+      const keyword = q ? searchKey(q) : "";
 
       cards.forEach(card => {
         const rawName = card.getAttribute("data-name") || "";
-        const name = rawName.normalize("NFKC").toLowerCase();
+        const name = card.getAttribute("data-key") || searchKey(rawName);
         const kana = card.getAttribute("data-kana") || "";
 
         const matchText = !keyword || name.includes(keyword);
@@ -2242,13 +2443,42 @@ galleries.forEach(gallery => {
       });
   }
 
+  // =========================
+  // 観察ノート用メタデータ（★を付けた写真のシャードだけ取得）
+  // =========================
+    // main.py の photo_meta_shard と同じ FNV-1a 32bit
+    function photoMetaShard(src, digits) {
+      let h = 0x811c9dc5;
+      for (const b of new TextEncoder().encode(src)) {
+        h ^= b;
+        h = Math.imul(h, 0x01000193) >>> 0;
+      }
+      return h.toString(16).padStart(8, "0").slice(0, digits);
+    }
+
+    function loadFavoriteMeta() {
+      const index = window.PHOTO_META_INDEX;
+      if (!index || !document.querySelector(".favorite-gallery")) return Promise.resolve();
+
+      const favs = loadFavorites();
+      const shards = new Set(
+        Object.keys(favs).filter(src => favs[src]).map(src => photoMetaShard(src, index.digits))
+      );
+      return Promise.all(
+        [...shards].filter(key => index.shards[key]).map(key =>
+          fetch(`${index.base}${key}.${index.shards[key]}.json`)
+            .then(r => (r.ok ? r.json() : {}))
+            .catch(() => ({}))
+            .then(shard => Object.assign(PHOTO_META, shard))
+        )
+      );
+    }
+
   // =========================
   // 観察ノート専用のキャプション関数
   // =========================
     function buildNoteCaption(src){
-      const name = window.SRC_TO_ALT?.[src] || "";
-      const meta = window.EXIF_CACHE?.[src];
-      const date = meta?.date || "";
+      const [name = "", date = ""] = PHOTO_META[src] || [];
     
       if (!name && !date) return "";
     
@@ -2268,14 +2498,11 @@ galleries.forEach(gallery => {
   // EXIF から年・月を取り出す関数
   // =========================
     function getDateFromExif(src){
-      const cache = window.EXIF_CACHE;
-      if (!cache) return null;
-    
-      const meta = cache[src];
-      if (!meta || !meta.date) return null;
+      const date = PHOTO_META[src]?.[1];
+      if (!date) return null;
     
       // "YYYY/MM/DD" → Date
-      const d = new Date(meta.date.replace(/\//g, "-"));
+      const d = new Date(date.replace(/\//g, "-"));
       if (isNaN(d)) return null;
     
       return {
@@ -2344,10 +2571,40 @@ galleries.forEach(gallery => {
   const emptyEl = document.querySelector(".section .search-empty");
 
   if (indexSearchInput && indexResults) {
-    const ALL_MUSHROOMS = window.ALL_MUSHROOMS || [];
+    const SEARCH_INDEX = window.SEARCH_INDEX || { base: "search/", shards: {} };
+    const shardCache = {};
     let page = 1;
+    let searchSeq = 0;
     const PER_PAGE = 30;
 
+    // クエリの文字のうち件数が一番少ないシャード（どれかが無ければ該当なし）
+    function pickShardChar(q) {
+      let best = null;
+      for (const ch of new Set(q)) {
+        const shard = SEARCH_INDEX.shards[ch];
+        if (!shard) return null;
+        if (best === null || shard[1] < SEARCH_INDEX.shards[best][1]) best = ch;
+      }
+      return best;
+    }
+
+    // シャードは文字ごとに 1 回だけ取得する
+    function loadShard(ch) {
+      if (ch === null) return Promise.resolve([]);
+      if (!shardCache[ch]) {
+        const [hash] = SEARCH_INDEX.shards[ch];
+        const url = `${SEARCH_INDEX.base}${ch.codePointAt(0).toString(16)}.${hash}.json`;
+        shardCache[ch] = fetch(url)
+          .then(r => (r.ok ? r.json() : []))
+          .then(rows => rows.map(([name, key, href, thumb, romaji]) => ({ name, key, href, thumb, romaji })))
+          .catch(() => {
+            delete shardCache[ch];
+            return [];
+          });
+      }
+      return shardCache[ch];
+    }
+
     function renderResults(list, q = "") {
       if (!q) {
         indexResults.innerHTML = "";
@@ -2418,13 +2675,18 @@ galleries.forEach(gallery => {
       });
     }
 
-    function doSearch() {
+    async function doSearch() {
+      const seq = ++searchSeq;
       const rawQ = indexSearchInput.value.trim().normalize("NFKC");
-      const q = rawQ.toLowerCase();
+      // ひらがな/カタカナ・長音・小書き・ローマ字の揺れはキー側で畳んである
+      const romaji = isRomajiQuery(rawQ);
+      const q = romaji ? romajiCanon(rawQ) : searchKey(rawQ);
+      const field = romaji ? "romaji" : "key";
 
-      const filtered = rawQ
-        ? ALL_MUSHROOMS.filter(m => (m.name_norm || "").includes(q))
-        : [];
+      const shard = q ? await loadShard(pickShardChar(q)) : [];
+      // 取得中に入力が進んでいたら古い結果は捨てる
+      if (seq !== searchSeq) return;
+      const filtered = shard.filter(m => (m[field] || "").includes(q));
 
       const totalPages = Math.max(1, Math.ceil(filtered.length / PER_PAGE));
       page = Math.min(Math.max(1, page), totalPages);
@@ -2458,7 +2720,7 @@ galleries.forEach(gallery => {
   // =========================
   const isFavoritePage = !!document.querySelector(".favorite-gallery");
 
-  renderFavoritePage();
+  favoriteMetaReady.then(renderFavoritePage);
 
   // =========================
   // 更新タイミングにだけフックする（ページ初期表示時）
@@ -2472,6 +2734,8 @@ galleries.forEach(gallery => {
 
   window.addEventListener("load", () => {
     sendHeight();
+    // 寸法の決まっていないギャラリーがあるときだけ、遅れて広がる高さを取り直す
+    if (galleries.length > 0 && [...galleries].every(isSizedGallery)) return;
     setTimeout(sendHeight, 800);
     setTimeout(sendHeight, 2000);
   });
@@ -2497,24 +2761,378 @@ galleries.forEach(gallery => {
 """
 
 # ===========================
-# EXIF キャッシュ
+# HTTP セッション（接続プール共有）
 # ===========================
-def load_exif_cache():
-    if not os.path.exists(CACHE_FILE):
-        return {}
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_metrics_lock = threading.Lock()
+HTTP_METRICS = {"requests": 0, "retries": 0, "errors": 0, "bytes": 0, "timings": []}
+
+def create_http_session(adapter=None):
+    """keep-alive 接続をプールする Session を作る。
+
+    adapter を渡すと http:// と https:// をその transport に差し替える
+    （ローカルの偽 transport でテストするため）。
+    """
+    session = requests.Session()
+    if adapter is None:
+        pool = max(HTTP_POOL_SIZE, EXIF_WORKERS)
+        adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def set_http_session(session):
+    global _http_session
+    with _http_session_lock:
+        _http_session = session
+
+def get_http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = create_http_session()
+        return _http_session
+
+def _record_http(url, status, nbytes, seconds, retried):
+    with _http_metrics_lock:
+        HTTP_METRICS["requests"] += 1
+        HTTP_METRICS["bytes"] += nbytes
+        if retried:
+            HTTP_METRICS["retries"] += 1
+        if status is None:
+            HTTP_METRICS["errors"] += 1
+        HTTP_METRICS["timings"].append((url, status, nbytes, seconds))
+
+def _retry_delay(attempt, response=None):
+    """指数バックオフ。429/503 の Retry-After（秒）があればそちらを優先（HTTP_RETRY_AFTER_MAX まで）"""
+    if response is not None:
+        after = response.headers.get("Retry-After", "")
+        if after.isdigit():
+            if float(after) > HTTP_RETRY_AFTER_MAX:
+                print(f"⚠️ Retry-After {after}s を {HTTP_RETRY_AFTER_MAX:g}s に切り詰め: {response.url}")
+                return HTTP_RETRY_AFTER_MAX
+            return float(after)
+    return HTTP_BACKOFF * (2 ** attempt)
+
+def http_get(url, timeout=None, **kwargs):
+    """共有セッションで GET する。429/5xx と接続エラーは指数バックオフで再試行"""
+    session = get_http_session()
+    timeout = timeout or HTTP_TIMEOUT
+
+    for attempt in range(HTTP_RETRIES + 1):
+        t0 = time.perf_counter()
+        try:
+            r = session.get(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            _record_http(url, None, 0, time.perf_counter() - t0, attempt > 0)
+            if attempt >= HTTP_RETRIES:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        _record_http(url, r.status_code, len(r.content), time.perf_counter() - t0, attempt > 0)
+        if r.status_code in HTTP_RETRY_STATUSES and attempt < HTTP_RETRIES:
+            time.sleep(_retry_delay(attempt, r))
+            continue
+        return r
+
+def print_http_metrics():
+    with _http_metrics_lock:
+        timings = sorted(t[3] for t in HTTP_METRICS["timings"])
+        summary = dict(HTTP_METRICS)
+    if not timings:
+        return
+    p50 = timings[len(timings) // 2]
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(
+        f"🌐 HTTP: {summary['requests']} 回（再試行 {summary['retries']} / エラー {summary['errors']}）"
+        f" {summary['bytes']:,} bytes  p50 {p50 * 1000:.0f}ms / p95 {p95 * 1000:.0f}ms"
+    )
+
+# ===========================
+# ビルド工程ごとの計測
+# ===========================
+BUILD_STAGE_LABELS = {
+    "articles": "記事同期",
+    "extract": "画像抽出",
+    "images": "画像処理",
+    "gallery": "キノコ・五十音ページ",
+    "index": "トップページ",
+    "favorite": "お気に入りページ",
+}
+BUILD_STAGES = []
+_build_stage = None
+_build_stage_lock = threading.Lock()
+
+@contextlib.contextmanager
+def build_stage(name):
+    """with の間の経過時間・HTTP の差分・stage_count() の値を 1 工程として記録する"""
+    global _build_stage
+    with _http_metrics_lock:
+        http_before = {k: HTTP_METRICS[k] for k in ("requests", "retries", "errors", "bytes")}
+    stage = {"name": name, "counters": {}}
+    _build_stage = stage
+    t0 = time.perf_counter()
     try:
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+        yield stage
+    finally:
+        stage["seconds"] = round(time.perf_counter() - t0, 3)
+        with _http_metrics_lock:
+            stage["http"] = {k: HTTP_METRICS[k] - v for k, v in http_before.items()}
+        _build_stage = None
+        BUILD_STAGES.append(stage)
+
+def stage_count(**counters):
+    """実行中の工程のカウンタに足す（工程の外では何もしない）"""
+    stage = _build_stage
+    if stage is None:
+        return
+    with _build_stage_lock:
+        for key, n in counters.items():
+            stage["counters"][key] = stage["counters"].get(key, 0) + n
+
+def build_report():
+    total = {"seconds": 0.0, "http": {}, "counters": {}}
+    for stage in BUILD_STAGES:
+        total["seconds"] += stage["seconds"]
+        for group in ("http", "counters"):
+            for key, n in stage[group].items():
+                total[group][key] = total[group].get(key, 0) + n
+    total["seconds"] = round(total["seconds"], 3)
+    return {
+        "finished": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "stages": BUILD_STAGES,
+        "total": total,
+    }
+
+def _format_stage(stage, previous=None):
+    c, h = stage["counters"], stage["http"]
+    label = BUILD_STAGE_LABELS.get(stage["name"], stage["name"])
+    # 全角は 2 桁分として揃える
+    pad = 20 - sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in label)
+    line = f"{label}{' ' * max(1, pad)}{stage['seconds']:8.2f}s"
+    if previous:
+        line += f" ({stage['seconds'] - previous['seconds']:+.2f}s)"
+    if h.get("requests"):
+        line += f"  HTTP {h['requests']} 回 {h['bytes']:,} bytes"
+    if "cache_hits" in c or "cache_misses" in c:
+        line += f"  キャッシュ {c.get('cache_hits', 0)}/{c.get('cache_hits', 0) + c.get('cache_misses', 0)}"
+    if c.get("pages_written") or c.get("pages_skipped"):
+        line += f"  ページ {c.get('pages_written', 0)} 書込・{c.get('pages_skipped', 0)} 据置"
+    if c.get("bytes_written"):
+        line += f"  書込 {c.get('files_written', 0)} 件 {c['bytes_written']:,} bytes"
+    return line
+
+def write_build_report(path=None):
+    """JSON を保存し、工程ごとの要約（前回との差つき）を表示する。
+
+    GitHub Actions 上ならジョブの Summary にも同じ表を出す。
+    """
+    path = path or BUILD_REPORT_FILE
+    if not BUILD_STAGES:
+        return
+    previous = {s["name"]: s for s in _load_json(path, {}).get("stages", [])}
+    report = build_report()
+    _save_json(path, report)
+
+    lines = [_format_stage(stage, previous.get(stage["name"])) for stage in BUILD_STAGES]
+    print(f"⏱ ビルド工程（合計 {report['total']['seconds']:.2f}s）")
+    for line in lines:
+        print(f"  {line}")
+
+    summary = os.getenv("GITHUB_STEP_SUMMARY")
+    if summary:
+        with open(summary, "a", encoding="utf-8") as f:
+            f.write(f"### ⏱ ビルド工程（合計 {report['total']['seconds']:.2f}s）\n\n```\n")
+            f.write("\n".join(lines) + "\n```\n")
+
+# ===========================
+# JSON キャッシュ共通
+# ===========================
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
-            if isinstance(data, dict):
+            if isinstance(data, type(default)):
                 return data
     except Exception:
         pass
-    return {}
+    return default
 
-def save_exif_cache(cache: dict):
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
+def _save_json(path, data, compact=False):
+    """一時ファイルに書いてから置き換える（途中で落ちても元のファイルは壊れない）"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        if compact:
+            text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        else:
+            text = json.dumps(data, ensure_ascii=False, indent=2)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+        stage_count(files_written=1, bytes_written=os.path.getsize(path))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# ===========================
+# 画像レコード キャッシュ
+# ===========================
+def _encode_column(values):
+    """同じ文字列が多い列は辞書（dict）と添字（codes）に分ける"""
+    strings = [v for v in values if v is not None]
+    if (
+        strings
+        and all(isinstance(v, str) for v in strings)
+        and len(set(strings)) * 2 <= len(strings)
+    ):
+        table = list(dict.fromkeys(strings))
+        index = {v: i for i, v in enumerate(table)}
+        return {"dict": table, "codes": [None if v is None else index[v] for v in values]}
+    return {"values": values}
+
+def _decode_column(column):
+    if "dict" in column:
+        table = column["dict"]
+        return [None if c is None else table[c] for c in column["codes"]]
+    return column["values"]
+
+def encode_image_records(records: dict):
+    """URL → レコードを列指向にする。
+
+    URL はディレクトリ部分（src.dir）とファイル名（src.name）、EXIF は exif.<項目> の列になる。
+    値が None の項目は保存しない。
+    """
+    srcs = list(records)
+    rows = []
+    for src in srcs:
+        row = {}
+        for key, value in records[src].items():
+            if key == "exif":
+                for name, v in (value or {}).items():
+                    row[f"exif.{name}"] = v
+            else:
+                row[key] = value
+        rows.append(row)
+
+    heads = [src.rpartition("/") for src in srcs]
+    columns = {
+        "src.dir": _encode_column([head + sep for head, sep, _ in heads]),
+        "src.name": {"values": [tail for _, _, tail in heads]},
+    }
+    for key in dict.fromkeys(k for row in rows for k in row):
+        columns[key] = _encode_column([row.get(key) for row in rows])
+    return {"schema": IMAGE_RECORDS_SCHEMA, "count": len(srcs), "columns": columns}
+
+def decode_image_records(data: dict):
+    columns = {key: _decode_column(col) for key, col in data["columns"].items()}
+    srcs = [d + n for d, n in zip(columns.pop("src.dir"), columns.pop("src.name"))]
+    records = {src: {"exif": {}} for src in srcs}
+    rows = list(records.values())
+    for key, values in columns.items():
+        if key.startswith("exif."):
+            name = key[len("exif."):]
+            for row, v in zip(rows, values):
+                if v is not None:
+                    row["exif"][name] = v
+        else:
+            for row, v in zip(rows, values):
+                if v is not None:
+                    row[key] = v
+    return records
+
+def load_image_records():
+    data = _load_json(IMAGE_RECORDS_FILE, {})
+    if data.get("schema") == IMAGE_RECORDS_SCHEMA:
+        records = decode_image_records(data)
+    elif "schema" in data:
+        print(f"⚠️ 未知の画像キャッシュ形式 schema={data['schema']} → 作り直します")
+        records = {}
+    elif data:
+        # schema 1：URL → レコードの dict（次の保存で新形式になる）
+        records = data
+    elif os.path.exists(CACHE_FILE):
+        # 旧 exif-cache.json の EXIF を引き継ぐ（寸法やサムネイルは次の処理で埋まる）
+        records = {src: {"exif": exif or {}} for src, exif in _load_json(CACHE_FILE, {}).items()}
+    else:
+        records = {}
+    replay_journal(records)
+    return records
+
+def save_image_records(records: dict):
+    # 本体を書き切ってからジャーナルを消す（間で落ちても再生は同じ結果になる）
+    _save_json(IMAGE_RECORDS_FILE, encode_image_records(records), compact=True)
+    if os.path.exists(IMAGE_JOURNAL_FILE):
+        os.remove(IMAGE_JOURNAL_FILE)
+
+class RecordJournal:
+    """処理済みレコードを 1 行ずつ追記する JSON Lines。
+
+    CHECKPOINT_EVERY 枚か CHECKPOINT_SECONDS 秒たまるごとに追記して fsync する。
+    ジョブがタイムアウトやキャンセルで止まっても、最後のチェックポイントまでは残る。
+    """
+
+    def __init__(self, path=None, every=None, seconds=None):
+        self.path = path or IMAGE_JOURNAL_FILE
+        self.every = max(1, every if every is not None else CHECKPOINT_EVERY)
+        self.seconds = seconds if seconds is not None else CHECKPOINT_SECONDS
+        self.pending = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, src, record):
+        self.pending.append(json.dumps([src, record], ensure_ascii=False, separators=(",", ":")))
+        if len(self.pending) >= self.every or time.monotonic() - self.last_flush >= self.seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab+") as f:
+                # 前回が行の途中で切れていたら、その行とつながらないよう改行から始める
+                head = b""
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    head = b"" if f.read(1) == b"\n" else b"\n"
+                f.write(head + ("\n".join(self.pending) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            self.written += len(self.pending)
+            self.pending = []
+            print(f"💾 チェックポイント: {self.written} 件をジャーナルに記録")
+        self.last_flush = time.monotonic()
+
+def replay_journal(records: dict, path=None):
+    """前回の途中までのレコードを records に書き戻す（壊れた最終行は捨てる）"""
+    path = path or IMAGE_JOURNAL_FILE
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    # 多バイト文字の途中で切れた行もあるので、バイト列のまま 1 行ずつ読んで復号する
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                src, record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                # 書き込み途中で止まった行（UnicodeDecodeError も ValueError）
+                continue
+            records[src] = record
+            count += 1
+    if count:
+        print(f"⏯ 前回中断した処理から再開: ジャーナルの {count} 件を復元")
+    return count
+
+def exif_view(records: dict):
+    """画像URL → EXIF の dict（キャプションや観察ノートのメタデータ用）"""
+    return {src: rec.get("exif") or {} for src, rec in records.items()}
+
+def load_exif_cache():
+    return exif_view(load_image_records())
 
 def _rational_to_float(val):
     try:
@@ -2528,6 +3146,8 @@ def _rational_to_float(val):
         return None
 
 def _exposure_to_str(val):
+    if val is None:
+        return ""
     if isinstance(val, tuple) and len(val) == 2 and val[1]:
         num, den = val
         return f"{num}/{den}"
@@ -2536,18 +3156,106 @@ def _exposure_to_str(val):
     except Exception:
         return ""
 
+# ===========================
+# APP1 から必要なタグだけを読む
+# ===========================
+# 0th IFD から読むタグ（Exif IFD へのポインタも含む）
+_ZEROTH_TAGS = frozenset({piexif.ImageIFD.Model, piexif.ImageIFD.ExifTag})
+# Exif IFD から読むタグ
+_EXIF_TAGS = frozenset({
+    piexif.ExifIFD.LensModel,
+    piexif.ExifIFD.ISOSpeedRatings,
+    piexif.ExifIFD.ISOSpeed,
+    piexif.ExifIFD.FNumber,
+    piexif.ExifIFD.ExposureTime,
+    piexif.ExifIFD.FocalLength,
+    piexif.ExifIFD.DateTimeOriginal,
+})
+# TIFF の型番号 → (1 要素のバイト数, struct の書式。None はバイト列のまま)
+_TIFF_TYPES = {
+    1: (1, "B"), 2: (1, None), 3: (2, "H"), 4: (4, "L"), 5: (8, "L"), 6: (1, "b"),
+    7: (1, None), 8: (2, "h"), 9: (4, "l"), 10: (8, "l"), 11: (4, "f"), 12: (8, "d"),
+}
+
+def _tiff_value(tiff, endian, entry):
+    """IFD エントリ 1 件の値を piexif.load と同じ形（int / tuple / bytes）で返す"""
+    typ, count = struct.unpack_from(endian + "HL", tiff, entry + 2)
+    if typ not in _TIFF_TYPES:
+        raise ValueError(f"不明な TIFF 型: {typ}")
+    size, fmt = _TIFF_TYPES[typ]
+    # 4 バイトに収まらない値はオフセットの先にある
+    if size * count > 4:
+        offset = struct.unpack_from(endian + "L", tiff, entry + 8)[0]
+    else:
+        offset = entry + 8
+
+    if typ == 2:  # ASCII（末尾の NUL を落とす）
+        return bytes(tiff[offset:offset + count - 1])
+    if typ == 7:  # UNDEFINED
+        return bytes(tiff[offset:offset + count])
+    if typ in (5, 10):  # (分子, 分母) の組
+        values = struct.unpack_from(f"{endian}{count * 2}{fmt}", tiff, offset)
+        data = tuple(zip(values[0::2], values[1::2]))
+    else:
+        data = struct.unpack_from(f"{endian}{count}{fmt}", tiff, offset)
+    return data[0] if len(data) == 1 else data
+
+def _read_ifd(tiff, endian, pointer, wanted):
+    """IFD を走査し、wanted に含まれるタグの値だけをデコードする"""
+    found = {}
+    n = struct.unpack_from(endian + "H", tiff, pointer)[0]
+    for i in range(n):
+        entry = pointer + 2 + 12 * i
+        tag = struct.unpack_from(endian + "H", tiff, entry)[0]
+        if tag in wanted:
+            found[tag] = _tiff_value(tiff, endian, entry)
+    return found
+
+def read_exif_tags(data):
+    """JPEG / APP1 の中身（b"Exif\0\0..."）/ TIFF から (0th, Exif) のタグ dict を返す。
+
+    memoryview 越しに読むので画像全体はコピーしない。サムネイル（1st IFD）や
+    GPS には触れない。読めない形式（WebP など）なら None。
+    """
+    buf = memoryview(data)
+    if buf[:2] == b"\xff\xd8":
+        state, info = _locate_exif_segment(buf)
+        if state == "need":
+            raise ValueError("APP1 の途中で途切れた JPEG")
+        if state == "none":
+            return {}, {}
+        tiff = buf[info[0] + 6:info[1]]
+    elif buf[:4] == b"Exif":
+        tiff = buf[6:]
+    elif buf[:2] in (b"II", b"MM"):
+        tiff = buf
+    else:
+        return None
+
+    endian = "<" if tiff[:2] == b"II" else ">"
+    pointer = struct.unpack_from(endian + "L", tiff, 4)[0]
+    zero = _read_ifd(tiff, endian, pointer, _ZEROTH_TAGS)
+    pointer = zero.pop(piexif.ImageIFD.ExifTag, None)
+    exif = _read_ifd(tiff, endian, pointer, _EXIF_TAGS) if isinstance(pointer, int) else {}
+    return zero, exif
+
 # ===========================
 # EXIF 抽出
 # ===========================
 def extract_exif_from_bytes(jpeg_bytes: bytes):
+    # JPEG 全体でも APP1 の中身（b"Exif\0\0..."）でも読める
     try:
-        exif_dict = piexif.load(jpeg_bytes)
+        tags = read_exif_tags(jpeg_bytes)
+        if tags is None:
+            # JPEG / TIFF 以外（WebP など）は piexif に任せる
+            exif_dict = piexif.load(jpeg_bytes)
+            tags = exif_dict.get("0th", {}), exif_dict.get("Exif", {})
     except Exception:
         return {}
+    return exif_fields(*tags)
 
-    zero = exif_dict.get("0th", {})
-    exif = exif_dict.get("Exif", {})
-
+def exif_fields(zero: dict, exif: dict):
+    """0th / Exif IFD のタグ dict → キャプション用の文字列 dict"""
     # Model
     model = zero.get(piexif.ImageIFD.Model, b"")
     if isinstance(model, bytes):
@@ -2564,7 +3272,7 @@ def extract_exif_from_bytes(jpeg_bytes: bytes):
         lens = clean_exif_str(str(lens))
 
     # ISO
-    iso = exif.get(piexif.ExifIFD.ISOSpeedRatings) or exif.get(piexif.ExifIFD.ISO)
+    iso = exif.get(piexif.ExifIFD.ISOSpeedRatings) or exif.get(piexif.ExifIFD.ISOSpeed)
     if isinstance(iso, (list, tuple)):
         iso = iso[0]
     iso_str = str(iso) if iso is not None else ""
@@ -2611,32 +3319,495 @@ def extract_exif_from_bytes(jpeg_bytes: bytes):
     }
 
 # ===========================
-# EXIF キャッシュ構築
+# ホスト単位のレート制限
 # ===========================
-def build_exif_cache(entries, cache: dict):
-    os.makedirs(CACHE_DIR, exist_ok=True)
+class HostRateLimiter:
+    """同じホストへのリクエストを rate 回/秒 以下に間引く（スレッドセーフ）"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+# ===========================
+# JPEG 先頭から APP1(Exif) セグメントを探す
+# ===========================
+def _locate_exif_segment(buf):
+    """JPEG 先頭バイト列 buf を走査する。
+
+    戻り値:
+      ("found", (start, end)) … buf[start:end] が "Exif" ヘッダーから始まる APP1 の中身
+      ("need", n)             … 判定には先頭 n バイトが必要
+      ("none", None)          … JPEG でない / SOS まで Exif が無い
+    """
+    if len(buf) < 2:
+        return "need", 2
+    if buf[0:2] != b"\xff\xd8":
+        return "none", None
+
+    pos = 2
+    while True:
+        if pos + 4 > len(buf):
+            return "need", pos + 4
+        if buf[pos] != 0xFF:
+            return "none", None
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # フィルバイト
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):  # SOS / EOI → ここから先はメタデータ無し
+            return "none", None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # 長さを持たないマーカー
+            pos += 2
+            continue
+
+        length = (buf[pos + 2] << 8) | buf[pos + 3]
+        end = pos + 2 + length
+        if marker == 0xE1:
+            if pos + 10 > len(buf):
+                return "need", pos + 10
+            if buf[pos + 4:pos + 10] == b"Exif\x00\x00":
+                if end > len(buf):
+                    return "need", end
+                return "found", (pos + 4, end)
+        pos = end
 
-    all_srcs = sorted({e["src"] for e in entries})
+# ===========================
+# 画像から EXIF 用のバイト列を取得
+# ===========================
+def _fetch_exif_bytes(src, full=False):
+    """(status_code, data) を返す。
+
+    range モードでは Range リクエストで先頭だけを取り、APP1 が窓より大きければ
+    足りない分だけ追加で取得する。サーバーが Range を無視して 200 を返した場合は
+    そのまま全体をダウンロードしたものとして扱う。
+    full=True（サムネイルも作る）ならモードに関係なく画像全体を取る。
+    """
+    if full or EXIF_FETCH_MODE != "range":
+        r = http_get(src)
+        return r.status_code, r.content
+
+    buf = b""
+    want = EXIF_RANGE_BYTES
+    while True:
+        offset = len(buf)
+        r = http_get(src, headers={"Range": f"bytes={offset}-{want - 1}"})
+        if r.status_code == 200:
+            return 200, r.content
+        if r.status_code == 416:  # 先頭位置がファイル末尾を超えた
+            return 200, buf
+        if r.status_code != 206:
+            return r.status_code, b""
+
+        buf += r.content
+        state, info = _locate_exif_segment(buf)
+        if state == "found":
+            start, end = info
+            return 200, buf[start:end]
+        if state == "none" or len(buf) < want:
+            # Exif 無し、または要求より短い = ファイル末尾に到達
+            return 200, buf
+        want = max(info, len(buf) + 4096)
+
+# ===========================
+# サムネイル（srcset 用）
+# ===========================
+def thumb_path(src, digest, width, ext):
+    """出力ディレクトリからの相対パス。URL と内容ハッシュの両方で名前が変わる"""
+    key = hashlib.sha1(src.encode("utf-8")).hexdigest()[:12]
+    return f"thumbs/{key}-{digest}-{width}.{ext}"
+
+def _thumb_files(src, record):
+    if not record.get("hash"):
+        return []
+    return [
+        thumb_path(src, record["hash"], w, ext)
+        for w in record.get("widths", [])
+        for ext in ("webp", "jpg")
+    ]
+
+def _write_thumbnails(img, src, digest, widths):
+    """向きを直した RGB 画像から widths の WebP / JPEG を書き出す"""
+    os.makedirs(THUMBS_DIR, exist_ok=True)
+    width, height = img.size
+    for w in reversed(widths):
+        # 大きい幅から順に縮めると LANCZOS の入力が小さくなって速い
+        img = img.resize((w, max(1, round(height * w / width))), Image.LANCZOS)
+        img.save(os.path.join(OUTPUT_DIR, thumb_path(src, digest, w, "webp")), "WEBP", quality=THUMB_QUALITY, method=4)
+        img.save(os.path.join(OUTPUT_DIR, thumb_path(src, digest, w, "jpg")), "JPEG", quality=THUMB_QUALITY, optimize=True, progressive=True)
+        stage_count(files_written=2, bytes_written=sum(
+            os.path.getsize(os.path.join(OUTPUT_DIR, thumb_path(src, digest, w, ext))) for ext in ("webp", "jpg")
+        ))
+
+def prune_thumbnails(entries, records: dict):
+    """どのレコードからも参照されないサムネイルファイルを消す"""
+    srcs = {e["src"] for e in entries}
+    keep = {
+        os.path.basename(p)
+        for src, rec in records.items() if src in srcs
+        for p in _thumb_files(src, rec)
+    }
+    removed = 0
+    for path in glob.glob(os.path.join(THUMBS_DIR, "*")):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+            removed += 1
+    if removed:
+        print(f"🗑 不要なサムネイル {removed} 件を削除")
+
+def srcset_attrs(src, records: dict):
+    """<picture> の WebP source と <img> の JPEG srcset を返す。サムネイルが無ければ空"""
+    record = records.get(src) or {}
+    widths = record.get("widths") or []
+    if not record.get("hash") or not widths:
+        return "", ""
+
+    def srcset(ext):
+        return ", ".join(f"{thumb_path(src, record['hash'], w, ext)} {w}w" for w in widths)
+
+    source = f'<source type="image/webp" srcset="{srcset("webp")}" sizes="{THUMB_SIZES}">'
+    img_attrs = f' srcset="{srcset("jpg")}" sizes="{THUMB_SIZES}"'
+    return source, img_attrs
+
+def size_attrs(src, records: dict, width=None):
+    """レコードの寸法から width / height / aspect-ratio を返す。寸法が無ければ空。
+
+    width を渡すと（?width=400 のような縮小版）その幅に合わせた高さにする。
+    """
+    record = records.get(src) or {}
+    w, h = record.get("width"), record.get("height")
+    if not w or not h:
+        return ""
+    if width and width < w:
+        w, h = width, max(1, round(h * width / w))
+    return f' width="{w}" height="{h}" style="aspect-ratio: {w} / {h}"'
+
+def placeholder_attrs(src, records: dict):
+    """LQIP を背景に敷く class / style。レコードに無ければ空"""
+    lqip = (records.get(src) or {}).get("lqip")
+    if not lqip:
+        return "", ""
+    return " has-lqip", f' style="background-image: url({lqip})"'
 
-    for src in all_srcs:
-        if src in cache:
+# ===========================
+# LQIP（低画質プレースホルダー）
+# ===========================
+def make_placeholder(img):
+    """LQIP_WIDTH 幅まで縮めた WebP の data URI（JPEG だとテーブル分で 5 倍ほど大きい）"""
+    width, height = img.size
+    w = max(1, min(LQIP_WIDTH, width))
+    small = img.convert("RGB").resize((w, max(1, round(height * w / width))), Image.BILINEAR)
+    buf = io.BytesIO()
+    small.save(buf, "WEBP", quality=50)
+    return "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+def fill_placeholders(records: dict):
+    """LQIP が無い処理済みレコードに、出力済みの一番小さいサムネイルから LQIP を足す。
+
+    元画像を取り直さずに済むので、LQIP 導入前のレコードもこれで埋まる。
+    """
+    filled = 0
+    for src, record in records.items():
+        if record.get("lqip"):
             continue
+        files = [p for p in _thumb_files(src, record) if p.endswith(".jpg")]
+        if not files:
+            continue
+        path = os.path.join(OUTPUT_DIR, files[0])
+        if not os.path.exists(path):
+            continue
+        with Image.open(path) as img:
+            record["lqip"] = make_placeholder(img)
+        filled += 1
+    if filled:
+        print(f"🖼 LQIP を {filled} 件追加")
+    return records
 
-        print(f"🔍 EXIF取得: {src}")
-        exif_data = {}
-        try:
-            r = requests.get(src, timeout=10)
-            if r.status_code == 200:
-                exif_data = extract_exif_from_bytes(r.content) or {}
-                print(f"  ↪ EXIF取得OK: {exif_data}")
-            else:
-                print(f"  ↪ HTTP {r.status_code} → 空データとして保存")
-        except Exception as e:
-            print(f"  ↪ 取得エラー: {e} → 空データとして保存")
+# ===========================
+# 知覚ハッシュ（pHash）
+# ===========================
+_DCT_COS = [[math.cos(math.pi * (2 * x + 1) * u / 64) for x in range(32)] for u in range(8)]
+
+def perceptual_hash(img):
+    """32x32 グレースケールの DCT 低周波 8x8 を中央値で 2 値化した 64bit（16進）。
+
+    似た写真（リサイズ・再圧縮・軽い補正）はハミング距離が小さくなる。
+    """
+    px = list(img.convert("L").resize((32, 32), Image.BILINEAR).getdata())
+    rows = [px[i * 32:(i + 1) * 32] for i in range(32)]
+    # 行方向 → 列方向に低周波 8 成分だけ DCT-II をかける
+    low = [[sum(c * v for c, v in zip(cos, row)) for cos in _DCT_COS] for row in rows]
+    coeffs = [
+        sum(c * low[y][u] for c, y in zip(cos, range(32)))
+        for cos in _DCT_COS
+        for u in range(8)
+    ]
+    ordered = sorted(coeffs)
+    median = (ordered[31] + ordered[32]) / 2
+    bits = 0
+    for c in coeffs:
+        bits = (bits << 1) | (c > median)
+    return f"{bits:016x}"
+
+# ===========================
+# 画像 1 枚の処理（1 回のダウンロードで全部）
+# ===========================
+def process_image(src, data: bytes):
+    """ダウンロード済みのバイト列から EXIF・寸法・向き・知覚ハッシュ・サムネイル・LQIP を作る。
+
+    Range 取得した APP1 だけのデータなら EXIF だけのレコードになる。
+    画像のデコードやサムネイル作成に失敗しても、読めた EXIF は残す
+    （同じデータなら何度やっても失敗するので取り直さない）。
+    """
+    exif = extract_exif_from_bytes(data) or {}
+    record = {"rev": IMAGE_RECORD_REV, "status": "ok" if any(exif.values()) else "no-exif", "exif": exif}
+    if not THUMB_WIDTHS:
+        return record
+    try:
+        record.update(_image_fields(src, data))
+    except Exception as e:
+        record.update({"widths": [], "image_error": f"{type(e).__name__}: {e}"})
+    return record
+
+def _image_fields(src, data):
+    """寸法・向き・知覚ハッシュ・LQIP を返し、サムネイルを書き出す"""
+    # ローカル原本の mmap はそのままファイルとして渡す（BytesIO に複製しない）
+    img = Image.open(data if isinstance(data, mmap.mmap) else io.BytesIO(data))
+    width, height = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    if orientation in (5, 6, 7, 8):  # 90度回転して表示される向き
+        width, height = height, width
+    widths = [w for w in sorted(THUMB_WIDTHS) if 0 < w < width]
+    # JPEG は DCT 段階で縮小デコードできる（回転前なので縦横どちらも最大幅以上を要求）
+    img.draft("RGB", (max(widths + [32]),) * 2)
+    img = ImageOps.exif_transpose(img).convert("RGB")
+
+    digest = hashlib.sha1(data).hexdigest()[:10]
+    _write_thumbnails(img, src, digest, widths)
+    return {
+        "width": width,
+        "height": height,
+        "orientation": orientation,
+        "phash": perceptual_hash(img),
+        "lqip": make_placeholder(img),
+        "hash": digest,
+        "widths": widths,
+    }
+
+# 取得の記録だけでページの見た目には関わらない項目
+_RECORD_BOOKKEEPING = ("status", "checked", "attempts", "image_error")
+
+def _page_fields(record):
+    """ページの入力ハッシュ用（再試行の時刻が変わっただけで作り直さない）"""
+    return {k: v for k, v in (record or {}).items() if k not in _RECORD_BOOKKEEPING}
+
+# 取り直す対象になる status（ネットワーク由来の失敗だけ。"error" は取り直しても変わらない）
+RETRY_STATUSES = ("http-error", "timeout")
+
+def record_failed(record):
+    """ネットワークの失敗で、バックオフしながら取り直すレコードか"""
+    return record.get("status") in RETRY_STATUSES
+
+def retry_due(record, now=None):
+    """失敗回数に応じた指数バックオフの待ちが明けたか"""
+    now = time.time() if now is None else now
+    attempts = max(1, record.get("attempts", 1))
+    wait = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return now >= record.get("checked", 0) + wait
+
+def image_record_ready(src, records: dict):
+    """処理済みで、サムネイルも出力に残っているか"""
+    record = records.get(src)
+    # status 導入前のレコードは、成功か失敗か分からないので普通に処理し直す
+    if record is None or "status" not in record:
+        return False
+    if not THUMB_WIDTHS:
+        return "exif" in record
+    return record.get("rev") == IMAGE_RECORD_REV and all(
+        os.path.exists(os.path.join(OUTPUT_DIR, p)) for p in _thumb_files(src, record)
+    )
+
+# ===========================
+# 画像 1 枚取得（ワーカースレッドで実行）
+# ===========================
+def _record_note(record):
+    note = f"  ↪ EXIF取得OK: {record['exif']}"
+    if "width" in record:
+        note += f"\n  ↪ {record['width']}x{record['height']} サムネイル {record['widths']}"
+    if "image_error" in record:
+        note += f"\n  ↪ 画像処理エラー: {record['image_error']} → EXIF だけ保存"
+    return note
+
+def _fetch_image(src, limiter):
+    """(レコード, ログ行) を返す。例外は握りつぶして空データ扱い"""
+    limiter.wait(src)
+    try:
+        status, data = _fetch_exif_bytes(src, full=bool(THUMB_WIDTHS))
+        if status == 200:
+            record = process_image(src, data)
+            return record, _record_note(record)
+        note = f"  ↪ HTTP {status} → 後で取り直します"
+        status = "http-error"
+    except requests.Timeout as e:
+        note = f"  ↪ タイムアウト: {e} → 後で取り直します"
+        status = "timeout"
+    except requests.RequestException as e:
+        note = f"  ↪ 取得エラー: {e} → 後で取り直します"
+        status = "http-error"
+    except Exception as e:
+        note = f"  ↪ 処理エラー: {e} → 空データとして保存"
+        status = "error"
+    # 失敗も記録する（ネットワークの失敗は次回以降バックオフしながら取り直す）
+    return {"rev": IMAGE_RECORD_REV, "status": status, "exif": {}, "widths": []}, note
+
+# ===========================
+# ローカル原本からの読み込み
+# ===========================
+def _local_name(src):
+    """src のファイル名（縮小プロキシ URL なら末尾に埋め込まれた元 URL のもの）"""
+    return os.path.basename(unquote(urlsplit(src).path)).lower()
+
+def resolve_local_images(srcs, root=None, manifest=None):
+    """src → ローカル原本のパス。対応表を優先し、残りはファイル名（拡張子違いも可）で探す。
+
+    同じ名前のファイルが複数ある src は取り違えないよう突き合わせない（対応表なら指定できる）。
+    """
+    root = LOCAL_IMAGES_DIR if root is None else root
+    manifest = LOCAL_IMAGES_MANIFEST if manifest is None else manifest
+    found = {}
+    if manifest and os.path.exists(manifest):
+        base = os.path.dirname(os.path.abspath(manifest))
+        for src, rel in _load_json(manifest, {}).items():
+            path = os.path.join(base, rel)
+            if os.path.isfile(path):
+                found[src] = path
+
+    if root and os.path.isdir(root):
+        # 日付フォルダごとに IMG_0001.JPG があるような同名ファイルは、どれか分からないので使わない
+        by_name, by_stem = {}, {}
+        for dirpath, _, files in os.walk(root):
+            for name in sorted(files):
+                path = os.path.join(dirpath, name)
+                by_name.setdefault(name.lower(), []).append(path)
+                by_stem.setdefault(os.path.splitext(name)[0].lower(), []).append(path)
+        ambiguous = []
+        for src in srcs:
+            if src in found:
+                continue
+            name = _local_name(src)
+            paths = by_name.get(name) or by_stem.get(os.path.splitext(name)[0]) or []
+            if len(paths) == 1:
+                found[src] = paths[0]
+            elif paths:
+                ambiguous.append((src, paths))
+        if ambiguous:
+            print(f"⚠️ 同じ名前のローカル原本が複数あるため {len(ambiguous)} 件は突き合わせません（対応表で指定してください）")
+            for src, paths in ambiguous[:5]:
+                print(f"  ↪ {src}: {', '.join(paths)}")
+
+    return {src: found[src] for src in srcs if src in found}
+
+def _read_local_image(src, path):
+    """ローカル原本をメモリマップで読み、(レコード, ログ行) を返す。
+
+    EXIF だけなら APP1 のページしか読まれず、サムネイル作成時も複製せずにデコードする。
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            record = process_image(src, data)
+        return record, f"  ↪ ローカル原本: {path}\n" + _record_note(record)
+    except Exception as e:
+        note = f"  ↪ 読込エラー: {path}: {e} → 空データとして保存"
+    return {"rev": IMAGE_RECORD_REV, "status": "error", "exif": {}, "widths": []}, note
 
-        cache[src] = exif_data
+# ===========================
+# 画像レコード構築
+# ===========================
+def build_image_records(entries, records: dict, workers=None):
+    """未処理の画像を 1 回ずつ取得し（ローカル原本があればそちらを読む）、EXIF からサムネイルまでまとめて作る"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
-    return cache
+    if workers is None:
+        workers = EXIF_WORKERS
+    workers = max(1, workers)
+
+    now = time.time()
+    todo, retries, waiting = [], [], 0
+    for src in sorted({e["src"] for e in entries}):
+        record = records.get(src)
+        if record is not None and record_failed(record):
+            if retry_due(record, now):
+                retries.append(src)
+            else:
+                waiting += 1
+        elif not image_record_ready(src, records):
+            todo.append(src)
+
+    stage_count(cache_hits=len({e["src"] for e in entries}) - len(todo) - len(retries) - waiting)
+    if retries or waiting:
+        # 古い失敗から順に、予算の分だけ取り直す
+        retries.sort(key=lambda src: records[src].get("checked", 0))
+        deferred = len(retries[RETRY_BUDGET:]) + waiting
+        retries = retries[:RETRY_BUDGET]
+        print(f"🔁 失敗した画像の再試行 {len(retries)} 件（待機・予算超過で見送り {deferred} 件）")
+        stage_count(retries=len(retries), retries_deferred=deferred)
+        todo = sorted(todo + retries)
+    if not todo:
+        return records
+
+    stage_count(cache_misses=len(todo))
+    local = resolve_local_images(todo)
+    stage_count(local_files=len(local))
+    if local or LOCAL_IMAGES_ONLY:
+        print(f"📂 ローカル原本 {len(local)} 件 / ネット取得 {0 if LOCAL_IMAGES_ONLY else len(todo) - len(local)} 件")
+    if LOCAL_IMAGES_ONLY:
+        # ローカルに無いものは未処理のまま残す（次のオンライン実行で取る）
+        todo = [src for src in todo if src in local]
+        if not todo:
+            return records
+
+    print(f"🧵 未処理の画像 {len(todo)} 件を並列数 {workers} で取得します")
+    limiter = HostRateLimiter(EXIF_HOST_RATE)
+
+    def work(src):
+        if src in local:
+            return _read_local_image(src, local[src])
+        return _fetch_image(src, limiter)
+
+    journal = RecordJournal()
+    # pool.map は入力順に結果を返すので、ログもキャッシュの並びも逐次版と同じになる
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        results = pool.map(work, todo)
+        for src, (record, note) in zip(todo, results):
+            print(f"🔍 画像処理: {src}")
+            print(note)
+            previous = records.get(src)
+            record["checked"] = int(time.time())
+            if record_failed(record):
+                # 連続失敗の回数（バックオフの段数）
+                failed_before = previous is not None and record_failed(previous)
+                record["attempts"] = previous.get("attempts", 0) + 1 if failed_before else 1
+            records[src] = record
+            journal.append(src, record)
+    finally:
+        # 中断されたら残りの取得は捨て、そこまでの結果だけ確実に書き残す
+        journal.flush()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return records
 
 # ===========================
 # EXIF → caption HTML（gap方式・日付統合）
@@ -2693,81 +3864,494 @@ def build_caption_html(alt, exif: dict):
     return html.escape(html_block, quote=True)
 
 # ===========================
-# はてなAPI 全記事取得
+# Atom 日時パース
+# ===========================
+def _parse_atom_time(s):
+    try:
+        return datetime.fromisoformat(s)
+    except (TypeError, ValueError):
+        return None
+
+def _entry_edited(entry):
+    """app:edited（無ければ updated）を返す。編集のたびに変わる方を優先"""
+    for tag in ("app:edited", "atom:updated"):
+        text = entry.findtext(tag, "", ATOM_NS).strip()
+        if text:
+            return text
+    return ""
+
+# ===========================
+# entry id → 保存キー
 # ===========================
-def fetch_hatena_articles_api():
+def article_key(entry_id):
+    """tag:blog.hatena.ne.jp,2013:blog-USER-BLOGID-ENTRYID の末尾 ENTRYID を使う。
+
+    形式が違う場合は id の SHA-1 先頭16桁（いずれもフィード内の位置に依存しない）
+    """
+    m = re.search(r"-(\d+)$", entry_id)
+    if m:
+        return m.group(1)
+    return hashlib.sha1(entry_id.encode("utf-8")).hexdigest()[:16]
+
+def _content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# ===========================
+# はてなAPI 記事同期（差分）
+# ===========================
+def fetch_hatena_articles_api(full_resync=None):
+    """AtomPub コレクションを新しい順にたどり、変わった記事だけ書き出す。
+
+    記事は entry id 由来のキーで articles/entry_<key>.html に保存し、
+    index に edited・内容ハッシュ・タイトル・カテゴリ・公開日を記録する。
+    前回同期以前の既知の記事に行き着いたページでページングを打ち切る。
+    full_resync=True（または HATENA_FULL_RESYNC=1）なら全ページを取り直し、
+    フィードから消えた記事のファイルを削除する。差分同期では削除を検出できないので、
+    前回の全件同期（index の last_full_sync）から HATENA_FULL_SYNC_DAYS 日たつと自動で全件同期する。
+
+    戻り値: {"added": [...], "updated": [...], "removed": [...]}（ファイルパス）
+    """
     os.makedirs(ARTICLES_DIR, exist_ok=True)
-    print("📡 はてなブログAPIから全記事取得中…")
+    if full_resync is None:
+        full_resync = HATENA_FULL_RESYNC
+
+    index = _load_json(ARTICLES_INDEX_FILE, {})
+    known = index.get("entries", {})
+    last_sync = _parse_atom_time(index.get("last_sync", ""))
+    last_full_sync = _parse_atom_time(index.get("last_full_sync", ""))
+    now = datetime.now(timezone.utc)
+
+    if not full_resync:
+        if last_sync is None:
+            print("ℹ️ 同期履歴が無いので全件同期します")
+            full_resync = True
+        elif any(not os.path.exists(e["file"]) for e in known.values()):
+            print("ℹ️ 保存済み記事が欠けているので全件同期します")
+            full_resync = True
+        elif HATENA_FULL_SYNC_DAYS > 0 and (
+            last_full_sync is None or now - last_full_sync >= timedelta(days=HATENA_FULL_SYNC_DAYS)
+        ):
+            print(f"ℹ️ 前回の全件同期から {HATENA_FULL_SYNC_DAYS:g} 日以上たったので、削除された記事の確認を兼ねて全件同期します")
+            full_resync = True
+
+    print(f"📡 はてなブログAPIから記事取得中…（{'全件' if full_resync else '差分'}同期）")
+
+    t0 = time.perf_counter()
     url = ATOM_ENDPOINT
-    count = 0
+    api_calls = 0
+    seen_keys = set()
+    changes = {"added": [], "updated": [], "removed": []}
+    newest = index.get("last_sync", "")
     while url:
         print(f"🔗 Fetching: {url}")
-        r = requests.get(url, auth=AUTH, headers=HEADERS)
+        r = http_get(url, auth=AUTH, headers=HEADERS)
+        api_calls += 1
         if r.status_code != 200:
             raise RuntimeError(f"❌ API取得失敗: {r.status_code} {r.text}")
 
         root = ET.fromstring(r.text)
-        ns = {"atom": "http://www.w3.org/2005/Atom"}
-        entries = root.findall("atom:entry", ns)
+        reached_known = False
 
-        for i, entry in enumerate(entries, 1):
-            content = entry.find("atom:content", ns)
-            if content is None:
+        for entry in root.findall("atom:entry", ATOM_NS):
+            entry_id = entry.findtext("atom:id", "", ATOM_NS).strip()
+            content = entry.find("atom:content", ATOM_NS)
+            if content is None or not entry_id:
                 continue
+            key = article_key(entry_id)
+            seen_keys.add(key)
+
+            edited = _entry_edited(entry)
+            edited_at = _parse_atom_time(edited)
+            newest_at = _parse_atom_time(newest)
+            if edited_at and (newest_at is None or edited_at > newest_at):
+                newest = edited
+
+            prev = known.get(key)
+            if prev and prev["edited"] == edited and os.path.exists(prev["file"]):
+                if not full_resync and edited_at and edited_at <= last_sync:
+                    reached_known = True
+                continue
+
             html_content = content.text or ""
-            filename = f"{ARTICLES_DIR}/article_{count+i}.html"
+            digest = _content_hash(html_content)
+            filename = f"{ARTICLES_DIR}/entry_{key}.html"
+            record = {
+                "id": entry_id,
+                "file": filename,
+                "edited": edited,
+                "sha1": digest,
+                "title": entry.findtext("atom:title", "", ATOM_NS).strip(),
+                "categories": [c.get("term", "") for c in entry.findall("atom:category", ATOM_NS)],
+                "published": entry.findtext("atom:published", "", ATOM_NS).strip(),
+            }
+            known[key] = record
+
+            # edited だけ変わって本文が同じなら書き直さない
+            if prev and prev.get("sha1") == digest and os.path.exists(filename):
+                continue
+
             with open(filename, "w", encoding="utf-8") as f:
                 f.write(html_content)
+            stage_count(files_written=1, bytes_written=os.path.getsize(filename))
+            changes["updated" if prev else "added"].append(filename)
             print(f"✅ 保存完了: {filename}")
 
-        count += len(entries)
-        next_link = root.find("atom:link[@rel='next']", ns)
+        if reached_known:
+            print("⏹ 前回同期済みの記事に到達したのでページングを終了")
+            break
+
+        next_link = root.find("atom:link[@rel='next']", ATOM_NS)
         url = next_link.attrib["href"] if next_link is not None else None
 
-    print(f"📦 合計 {count} 件の記事を保存しました。")
+    if full_resync:
+        # 全件見たので、今回現れなかった記事は削除済み
+        for key in [k for k in known if k not in seen_keys]:
+            changes["removed"].append(known.pop(key)["file"])
+
+        # index に載っていない entry_*.html と旧形式の article_N.html も片付ける
+        tracked = {os.path.normpath(e["file"]) for e in known.values()}
+        for pattern in ("entry_*.html", "article_*.html"):
+            for path in glob.glob(f"{ARTICLES_DIR}/{pattern}"):
+                if os.path.normpath(path) not in tracked and path not in changes["removed"]:
+                    changes["removed"].append(path)
+
+        for path in changes["removed"]:
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"🗑 削除: {path}")
+
+    if full_resync:
+        index["last_full_sync"] = now.isoformat(timespec="seconds")
+    _save_json(ARTICLES_INDEX_FILE, {
+        "last_sync": newest,
+        "last_full_sync": index.get("last_full_sync", ""),
+        "entries": known,
+    })
+
+    stage_count(
+        api_calls=api_calls,
+        articles_added=len(changes["added"]),
+        articles_updated=len(changes["updated"]),
+        articles_removed=len(changes["removed"]),
+    )
+    elapsed = time.perf_counter() - t0
+    print(
+        f"📦 API {api_calls} 回 / {len(seen_keys)} 件確認 / "
+        f"追加 {len(changes['added'])}・更新 {len(changes['updated'])}・削除 {len(changes['removed'])}"
+        f"（{elapsed:.1f}s）"
+    )
+    return changes
 
 # ===========================
-# HTML から画像抽出
+# 除外フィルター
 # ===========================
-def fetch_images():
-    print("📂 HTMLから画像抽出中…")
-    entries = []
+class ExcludeFilter:
+    """除外パターンを 1 本の正規表現にまとめ、1 回の走査で判定する。
+
+    各パターンを名前付きグループ (?P<p0>...)|(?P<p1>...) にしておき、
+    当たったグループ名からパターンごとのヒット数を数える。
+    グループを持つパターン（後方参照の番号がずれる）や、グループで包めない
+    パターン（先頭以外に置けないインラインフラグなど）は連結せず個別に判定する。
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.hits = [0] * len(self.patterns)
+        joinable, self._each = [], []
+        for i, p in enumerate(self.patterns):
+            regex = re.compile(p)
+            try:
+                wrapped = regex.groups == 0 and re.compile(f"(?:{p})").groups == 0
+            except re.error:
+                wrapped = False
+            if wrapped:
+                joinable.append(i)
+            else:
+                self._each.append((i, regex))
+        self._combined = re.compile(
+            "|".join(f"(?P<p{i}>{self.patterns[i]})" for i in joinable)
+        ) if joinable else None
+
+    @classmethod
+    def load(cls, path=None):
+        """パターンファイルを読む。無ければ組み込みの EXCLUDE_PATTERNS を使う。
+
+        ファイルがあるのに読めない（JSON の誤り・文字列配列でない・正規表現の誤り）ときは、
+        残す画像が黙って変わらないよう ValueError で止める。
+        """
+        path = path or EXCLUDE_PATTERNS_FILE
+        if not os.path.exists(path):
+            return cls(EXCLUDE_PATTERNS)
+        try:
+            with open(path, encoding="utf-8") as f:
+                patterns = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"❌ 除外パターン {path} の JSON が不正です: {e}") from e
+        if isinstance(patterns, dict):
+            patterns = patterns.get("patterns")
+        if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+            raise ValueError(f"❌ 除外パターン {path} は文字列の配列（または {{\"patterns\": [...]}}）にしてください")
+        try:
+            loaded = cls(patterns)
+        except re.error as e:
+            raise ValueError(f"❌ 除外パターン {path} の正規表現が不正です: {e}") from e
+        print(f"⚙️ 除外パターンを {path} から読み込み（{len(patterns)} 件）")
+        return loaded
+
+    def __call__(self, text):
+        if self._combined is not None:
+            m = self._combined.search(text)
+            if m is not None:
+                self.hits[int(m.lastgroup[1:])] += 1
+                return True
+        for i, regex in self._each:
+            if regex.search(text):
+                self.hits[i] += 1
+                return True
+        return False
+
+    def print_stats(self):
+        if not any(self.hits):
+            return
+        print("🚫 除外パターンのヒット数:")
+        for pattern, n in zip(self.patterns, self.hits):
+            print(f"  {n:>6}  {pattern}")
 
-    exclude_patterns = [
-        r'はてなブックマーク',
-        r'^\d{4}年',
-        r'^この記事をはてなブックマークに追加$',
-        r'^ワ行$',
-        r'キノコと田舎遊び',
-    ]
+# ===========================
+# 記事 1 件から画像抽出（ストリーミング）
+# ===========================
+# BeautifulSoup(html.parser) が空要素として即閉じるタグ
+_VOID_TAGS = frozenset({
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed",
+    "frame", "hr", "image", "img", "input", "isindex", "keygen", "link",
+    "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+})
+# この中の文字列は get_text() に含まれない
+_NON_TEXT_TAGS = frozenset({"rt", "rp", "style", "script", "template"})
+
+class _ImageExtractor(HTMLParser):
+    """DOM を作らずに <img alt src> を拾う。
+
+    以前の BeautifulSoup 版と同じ結果になるよう、
+      - 最初の .entry-body 要素の中だけを見る（無ければ文書全体）
+      - title が除外パターンに当たる iframe の中身は捨てる
+      - 文字列が除外パターンに当たる <a> の中身は捨てる
+    を、開いている要素のスタックだけで判定する。
+    <a> の文字列は閉じるまで分からないので、画像は候補として貯めておき、
+    close() 後にまとめて判定する。
+    """
+
+    def __init__(self, is_excluded):
+        super().__init__(convert_charrefs=True)
+        self.is_excluded = is_excluded
+        self.stack = []          # [(tag, frame)] frame は a / iframe のときだけ dict
+        self.closed_voids = []
+        self.text = []
+        self.non_text_depth = 0
+        self.excluded_iframes = 0
+        self.body_depth = None   # .entry-body が開いている間、そのスタック位置
+        self.body_seen = False
+        self.candidates = []     # (alt, src, in_body, frames)
+
+    # ---- 文字列 ----
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def _flush_text(self):
+        if not self.text:
+            return
+        text = "".join(self.text).strip()
+        self.text = []
+        if not text or self.non_text_depth or self.excluded_iframes:
+            return
+        for _, frame in self.stack:
+            if frame and frame["tag"] == "a":
+                frame["text"].append(text)
+
+    def handle_comment(self, data):
+        self._flush_text()
+
+    def handle_decl(self, decl):
+        self._flush_text()
+
+    def handle_pi(self, data):
+        self._flush_text()
+
+    def unknown_decl(self, data):
+        self._flush_text()
+
+    # ---- タグ ----
+    def handle_starttag(self, tag, attrs, auto_close=True):
+        self._flush_text()
+        attrs = {k: v or "" for k, v in attrs}
+        in_body = self.body_depth is not None
+
+        if not self.body_seen and "entry-body" in attrs.get("class", "").split():
+            self.body_seen = True
+            self.body_depth = len(self.stack)
+
+        frame = None
+        if tag == "a":
+            frame = {"tag": "a", "in_body": in_body, "text": [], "excluded": False}
+        elif tag == "iframe":
+            excluded = self.is_excluded(attrs.get("title", ""))
+            frame = {"tag": "iframe", "in_body": in_body, "excluded": excluded}
+            self.excluded_iframes += excluded
+        elif tag == "img":
+            frames = [f for _, f in self.stack if f]
+            self.candidates.append((attrs.get("alt", ""), attrs.get("src", ""), in_body, frames))
+
+        self.stack.append((tag, frame))
+        if tag in _NON_TEXT_TAGS:
+            self.non_text_depth += 1
+
+        if auto_close and tag in _VOID_TAGS:
+            self._pop_to(tag)
+            self.closed_voids.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, auto_close=False)
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        if tag in self.closed_voids:
+            self.closed_voids.remove(tag)
+            return
+        self._pop_to(tag)
+
+    def _pop_to(self, tag):
+        if not any(t == tag for t, _ in self.stack):
+            return
+        while self.stack:
+            name = self._pop()
+            if name == tag:
+                break
+
+    def _pop(self):
+        name, frame = self.stack.pop()
+        if name in _NON_TEXT_TAGS:
+            self.non_text_depth -= 1
+        if frame:
+            if frame["tag"] == "a":
+                frame["excluded"] = self.is_excluded("".join(frame["text"]))
+            elif frame["excluded"]:
+                self.excluded_iframes -= 1
+        if self.body_depth is not None and len(self.stack) == self.body_depth:
+            self.body_depth = None
+        return name
+
+    def close(self):
+        super().close()
+        self._flush_text()
+        while self.stack:
+            self._pop()
+
+    def images(self):
+        out = []
+        for alt, src, in_body, frames in self.candidates:
+            if self.body_seen:
+                if not in_body:
+                    continue
+                # .entry-body より外側の a / iframe は消されない
+                frames = [f for f in frames if f["in_body"]]
+            if any(f["excluded"] for f in frames):
+                continue
+            alt = alt.strip()
+            if not alt or not src:
+                continue
+            if self.is_excluded(alt):
+                continue
+            out.append({"alt": alt, "src": src})
+        return out
 
-    for html_file in glob.glob(f"{ARTICLES_DIR}/*.html"):
-        with open(html_file, encoding="utf-8") as f:
-            soup = BeautifulSoup(f, "html.parser")
+def extract_images_from_html(html_text, exclude):
+    """exclude は文字列 → 除外するか を返す callable（ExcludeFilter など）"""
+    parser = _ImageExtractor(exclude)
+    parser.feed(html_text)
+    parser.close()
+    return parser.images()
 
-        body_div = soup.find(class_="entry-body") or soup
+# ===========================
+# 記事バッチ解析（ワーカープロセスで実行）
+# ===========================
+def _extract_images_batch(paths, patterns):
+    """paths の各記事を解析し、([(alt, src), ...] のリスト, パターン別ヒット数) を返す"""
+    exclude = ExcludeFilter(patterns)
+    results = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            images = extract_images_from_html(f.read(), exclude)
+        results.append([(img["alt"], img["src"]) for img in images])
+    return results, exclude.hits
+
+def _article_workers(n_batches, workers=None):
+    if workers is None:
+        workers = ARTICLE_WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, n_batches))
 
-        for iframe in body_div.find_all("iframe"):
-            title = iframe.get("title", "")
-            if any(re.search(p, title) for p in exclude_patterns):
-                iframe.decompose()
+# ===========================
+# HTML から画像抽出
+# ===========================
+def fetch_images(workers=None):
+    print("📂 HTMLから画像抽出中…")
 
-        for a in body_div.find_all("a"):
-            text = a.get_text(strip=True)
-            if any(re.search(p, text) for p in exclude_patterns):
-                a.decompose()
+    # 除外パターンや抽出ロジックが変わったら全記事を解析し直す
+    exclude = ExcludeFilter.load()
+    cache_key = {"rev": IMAGE_EXTRACTOR_REV, "patterns": exclude.patterns}
+    cache = _load_json(IMAGES_CACHE_FILE, {})
+    cached = cache.get("articles", {}) if cache.get("key") == cache_key else {}
+
+    # 並列でも逐次でも同じ順に並ぶよう、パス順で固定する
+    paths = sorted(glob.glob(f"{ARTICLES_DIR}/*.html"))
+    digests = []
+    per_article = [None] * len(paths)
+    for i, html_file in enumerate(paths):
+        with open(html_file, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        digests.append(digest)
+        per_article[i] = cached.get(digest)
+
+    todo = [i for i, images in enumerate(per_article) if images is None]
+    hits = len(paths) - len(todo)
+    batches = [todo[i:i + ARTICLE_BATCH_SIZE] for i in range(0, len(todo), ARTICLE_BATCH_SIZE)]
+    n_workers = _article_workers(len(batches), workers)
+
+    def merge(batch, result):
+        images_list, pattern_hits = result
+        for i, images in zip(batch, images_list):
+            per_article[i] = [{"alt": alt, "src": src} for alt, src in images]
+        for j, n in enumerate(pattern_hits):
+            exclude.hits[j] += n
+
+    if n_workers > 1:
+        print(f"🧵 {len(todo)} 記事を {n_workers} プロセスで解析")
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [
+                pool.submit(_extract_images_batch, [paths[i] for i in batch], exclude.patterns)
+                for batch in batches
+            ]
+            # 投入順に受け取るので結果の並びは逐次版と同じ
+            for batch, future in zip(batches, futures):
+                merge(batch, future.result())
+    else:
+        for batch in batches:
+            merge(batch, _extract_images_batch([paths[i] for i in batch], exclude.patterns))
 
-        imgs = body_div.find_all("img")
-        for img in imgs:
-            alt = (img.get("alt") or "").strip()
-            src = img.get("src")
-            if not alt or not src:
-                continue
-            if any(re.search(p, alt) for p in exclude_patterns):
-                continue
+    entries = []
+    fresh = {}
+    for digest, images in zip(digests, per_article):
+        fresh[digest] = images
+        entries.extend(images)
 
-            entries.append({"alt": alt, "src": src})
+    # 今回存在した記事の分だけ残す（消えた記事のエントリは捨てる）
+    _save_json(IMAGES_CACHE_FILE, {"key": cache_key, "articles": fresh})
 
+    print(f"🗂 解析キャッシュ: ヒット {hits} / ミス {len(todo)}")
+    stage_count(cache_hits=hits, cache_misses=len(todo), images_found=len(entries))
+    exclude.print_stats()
     print(f"🧩 画像検出数: {len(entries)} 枚")
     return entries
 
@@ -2783,11 +4367,110 @@ def get_aiuo_group(name):
             return group
     return "その他"
 
+# ===========================
+# 差分出力（入力ハッシュ方式）
+# ===========================
+def template_version():
+    """共通タグとテンプレート版数から決まる値。変われば全ページが作り直しになる"""
+    h = hashlib.sha1(str(GALLERY_TEMPLATE_REV).encode())
+    for part in (STYLE_TAG, LIGHTGALLERY_TAGS, SCRIPT_TAG, SITE_BASE_URL):
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()[:12]
+
+# ===========================
+# 共通 CSS / JS（内容ハッシュ付きファイル）
+# ===========================
+def _write_asset(name, ext, content):
+    """assets/<name>.<hash>.<ext> を書き、同名の古い版を消す。SITE_BASE_URL からの URL を返す"""
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()[:10]
+    filename = f"{name}.{digest}.{ext}"
+    path = os.path.join(ASSETS_DIR, filename)
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        stage_count(files_written=1, bytes_written=os.path.getsize(path))
+        print(f"📦 {filename} を書き出し（{len(content.encode('utf-8')):,} bytes）")
+    for old in glob.glob(os.path.join(ASSETS_DIR, f"{name}.*.{ext}")):
+        if os.path.basename(old) != filename:
+            os.remove(old)
+            print(f"🗑 古いアセット削除: {os.path.basename(old)}")
+    return f"{SITE_BASE_URL.rstrip('/')}/assets/{filename}" if SITE_BASE_URL else f"assets/{filename}"
+
+def page_assets():
+    """STYLE_TAG / SCRIPT_TAG の中身を外部ファイルに出し、各ページに置く参照タグを返す。
+
+    ページごとに同じ CSS / JS を埋め込まず、ブラウザには一度だけ取らせる。
+    ファイル名が内容で変わるので、長期キャッシュしても古い版を掴まない。
+    SITE_BASE_URL を空にするとページからの相対パスで参照する（ローカル確認用）。
+    """
+    os.makedirs(ASSETS_DIR, exist_ok=True)
+    css = STYLE_TAG[len("<style>"):-len("</style>")]
+    loader, js = re.fullmatch(
+        r"(<script src=[^>]*></script>)\s*<script>(.*)</script>\s*", SCRIPT_TAG, re.S
+    ).groups()
+    css_href = _write_asset("gallery", "css", css)
+    js_href = _write_asset("gallery", "js", js)
+    return {
+        "style": f'<link rel="stylesheet" href="{css_href}">',
+        "script": f'{loader}\n<script src="{js_href}"></script>\n',
+    }
+
+class IncrementalOutput:
+    """ページごとの入力ハッシュを manifest に持ち、変わったページだけ書く。
+
+    今回の生成で出てこなかったページ（消えたキノコ）は finish() で削除する。
+    """
+
+    def __init__(self):
+        self.template = template_version()
+        self.previous = _load_json(OUTPUT_MANIFEST_FILE, {}).get("pages", {})
+        self.current = {}
+        self.written = 0
+        self.skipped = 0
+        self.removed = 0
+
+    def input_hash(self, kind, payload):
+        data = json.dumps([self.template, kind, payload], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def is_fresh(self, path, digest):
+        # 同じファイル名に別ページが当たった場合（safe_filename の衝突）は必ず書く
+        return (
+            path not in self.current
+            and self.previous.get(path) == digest
+            and os.path.exists(path)
+        )
+
+    def write(self, path, digest, render):
+        """render() は HTML 文字列を返す関数。スキップ時は呼ばない"""
+        if self.is_fresh(path, digest):
+            self.skipped += 1
+            stage_count(pages_skipped=1)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(render())
+            self.written += 1
+            stage_count(pages_written=1, files_written=1, bytes_written=os.path.getsize(path))
+        self.current[path] = digest
+
+    def finish(self):
+        for path in self.previous:
+            if path not in self.current and os.path.exists(path):
+                os.remove(path)
+                self.removed += 1
+                stage_count(pages_removed=1)
+                print(f"🗑 削除: {path}")
+        _save_json(OUTPUT_MANIFEST_FILE, {"pages": self.current})
+        print(f"📝 ページ: 書き込み {self.written} / 変更なし {self.skipped} / 削除 {self.removed}")
+
 # ===========================
 # ギャラリー生成（キノコページ & 五十音ページ）
 # ===========================
-def generate_gallery(entries, exif_cache):
+def generate_gallery(entries, exif_cache, images=None):
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    images = images or {}
+    out = IncrementalOutput()
+    assets = page_assets()
 
     # alt → [画像URL1, 画像URL2…]
     grouped = {}
@@ -2801,7 +4484,7 @@ def generate_gallery(entries, exif_cache):
     group_links_html += "</div>"
 
     # ① 各キノコページ
-    for alt, imgs in grouped.items():
+    def render_mushroom_page(alt, imgs):
         html_parts = []
 
         # タイトル（キノコ名 + 枚数）
@@ -2820,14 +4503,20 @@ def generate_gallery(entries, exif_cache):
             thumb = src + "?width=300"
             exif = exif_cache.get(src, {}) or {}
             caption_attr = build_caption_html(alt, exif)
+            # src は元画像のまま（お気に入りのキー）。グリッドは srcset の縮小版を使う
+            source, srcset = srcset_attrs(src, images)
+            img_tag = f'<img src="{src}"{srcset}{size_attrs(src, images)} alt="{html.escape(alt)}" loading="lazy">'
+            if source:
+                img_tag = f"<picture>{source}{img_tag}</picture>"
+            lqip_class, lqip_style = placeholder_attrs(src, images)
 
             html_parts.append(
-                f'<a class="gallery-item" href="{src}" '
+                f'<a class="gallery-item{lqip_class}" href="{src}"{lqip_style} '
                 f'data-exthumbimage="{thumb}" '
                 f'data-sub-html="{caption_attr}">'
                 f'<span class="thumb-fav">☆</span>'   # ← ★これだけ追加
                 f'<span class="spores"></span>'
-                f'<img src="{src}" alt="{html.escape(alt)}" loading="lazy">'
+                f'{img_tag}'
                 f'</a>'
             )
         html_parts.append("</div>")
@@ -2836,15 +4525,23 @@ def generate_gallery(entries, exif_cache):
         html_parts.append(group_links_html)
 
         # スタイル・LG・JS
-        html_parts.append(STYLE_TAG)
+        html_parts.append(assets["style"])
         html_parts.append(LIGHTGALLERY_TAGS)
-        html_parts.append(SCRIPT_TAG)
+        html_parts.append(assets["script"])
 
-        page_html = "".join(html_parts)
+        return "".join(html_parts)
 
-        safe = safe_filename(alt)
-        with open(f"{OUTPUT_DIR}/{safe}.html", "w", encoding="utf-8") as f:
-            f.write(page_html)
+    for alt, imgs in grouped.items():
+        digest = out.input_hash("mushroom", [
+            alt, imgs,
+            [exif_cache.get(src) or {} for src in imgs],
+            [_page_fields(images.get(src)) for src in imgs],
+        ])
+        out.write(
+            f"{OUTPUT_DIR}/{safe_filename(alt)}.html",
+            digest,
+            lambda alt=alt, imgs=imgs: render_mushroom_page(alt, imgs),
+        )
 
     # ===========================
     # ② 五十音ページ（完全修正版）
@@ -2860,11 +4557,7 @@ def generate_gallery(entries, exif_cache):
         if g in aiuo_dict:
             aiuo_dict[g].append(alt)
     
-    for g, names in aiuo_dict.items():
-        # ★ 何も無い行はページを作らない
-        if not names:
-            continue
-    
+    def render_aiuo_page(g, names):
         html_parts = []
     
         # -------------------------
@@ -2922,9 +4615,11 @@ def generate_gallery(entries, exif_cache):
             esc_kana = html.escape(first_char)
     
             img_tag = ""
+            lqip_class, lqip_style = placeholder_attrs(thumb_src, images)
             if thumb_src:
                 img_tag = (
-                    f"<img src='{thumb_src}?width=400' "
+                    f"<img src='{thumb_src}?width=400'"
+                    f"{size_attrs(thumb_src, images, 400)} "
                     f"alt='{esc_name}' loading='lazy'>"
                 )
     
@@ -2932,8 +4627,9 @@ def generate_gallery(entries, exif_cache):
             <a href="{safe}.html?from=aiuo&kana={html.escape(g)}"
                class="mushroom-card"
                data-name="{esc_name}"
+               data-key="{html.escape(search_key(n))}"
                data-kana="{esc_kana}">
-              <div class="mushroom-card-thumb">
+              <div class="mushroom-card-thumb{lqip_class}"{lqip_style}>
                 <span class="card-fav">☆</span>
                 {img_tag}
               </div>
@@ -2958,22 +4654,155 @@ def generate_gallery(entries, exif_cache):
         # -------------------------
         # 共通タグ
         # -------------------------
-        html_parts.append(STYLE_TAG)
+        html_parts.append(assets["style"])
         html_parts.append(LIGHTGALLERY_TAGS)
-        html_parts.append(SCRIPT_TAG)
-    
-        page_html = "".join(html_parts)
-    
-        with open(f"{OUTPUT_DIR}/{safe_filename(g)}.html", "w", encoding="utf-8") as f:
-            f.write(page_html)
+        html_parts.append(assets["script"])
     
+        return "".join(html_parts)
+
+    for g, names in aiuo_dict.items():
+        # ★ 何も無い行はページを作らない
+        if not names:
+            continue
+
+        # カードに使うのは名前と 1 枚目の画像だけ
+        cards = []
+        for n in sorted(names):
+            first = (grouped.get(n) or [""])[0]
+            cards.append([n, search_key(n), first, size_attrs(first, images, 400), placeholder_attrs(first, images)])
+        out.write(
+            f"{OUTPUT_DIR}/{safe_filename(g)}.html",
+            out.input_hash("aiuo", [g, cards]),
+            lambda g=g, names=names: render_aiuo_page(g, names),
+        )
+
+    out.finish()
     return grouped
 
+# ===========================
+# 検索キー（かな・長音・小書き・ローマ字の揺れを畳む）
+# ===========================
+# SCRIPT_TAG の searchKey / romajiCanon と同じ表を使うこと
+_SMALL_KANA = str.maketrans("ァィゥェォッャュョヮヵヶ", "アイウエオツヤユヨワカケ")
+
+_ROMAJI_RULES = [
+    (re.compile(pattern), to) for pattern, to in (
+        ("tch", "tty"), ("sh", "sy"), ("ch", "ty"), ("ts", "t"), ("j", "zy"), ("f", "h"),
+        ("syi", "si"), ("tyi", "ti"), ("zyi", "zi"), ("m(?=[bp])", "n"), ("nn", "n"),
+        ("[^a-z0-9]", ""),
+    )
+]
+
+# カタカナ → 訓令式ローマ字（ヘボン式の入力は romaji_canon で訓令式に寄せる）
+_KANA_ROMAJI = {"ヤ": "ya", "ユ": "yu", "ヨ": "yo", "ワ": "wa", "ヰ": "i", "ヱ": "e", "ヲ": "o", "ン": "n", "ヴ": "vu"}
+for _row, _consonant in (
+    ("アイウエオ", ""), ("カキクケコ", "k"), ("ガギグゲゴ", "g"), ("サシスセソ", "s"),
+    ("ザジズゼゾ", "z"), ("タチツテト", "t"), ("ダヂヅデド", "d"), ("ナニヌネノ", "n"),
+    ("ハヒフヘホ", "h"), ("バビブベボ", "b"), ("パピプペポ", "p"), ("マミムメモ", "m"),
+    ("ラリルレロ", "r"),
+):
+    for _kana, _vowel in zip(_row, "aiueo"):
+        _KANA_ROMAJI[_kana] = _consonant + _vowel
+_KANA_ROMAJI.update({"ヂ": "zi", "ヅ": "zu", "ヵ": "ka", "ヶ": "ke", "ヮ": "wa"})
+_YOON = {"ャ": "ya", "ュ": "yu", "ョ": "yo", "ァ": "a", "ィ": "i", "ゥ": "u", "ェ": "e", "ォ": "o"}
+
+def _to_katakana(text):
+    return "".join(
+        chr(ord(c) + 0x60) if "\u3041" <= c <= "\u3096" or c in "ゝゞ" else c
+        for c in text
+    )
+
+def search_key(name):
+    """NFKC → 小文字 → ひらがなをカタカナへ → 長音「ー」を除く → 小書きを並字へ"""
+    key = _to_katakana(unicodedata.normalize("NFKC", name).lower())
+    return key.replace("ー", "").translate(_SMALL_KANA)
+
+def romaji_canon(text):
+    """ヘボン式・訓令式・撥音の書き方の違いを 1 つの綴りに寄せる"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    for pattern, to in _ROMAJI_RULES:
+        text = pattern.sub(to, text)
+    return text
+
+def romaji_key(name):
+    """かなだけの名前をローマ字キーにする。漢字などが混じる名前は空"""
+    kana = _to_katakana(unicodedata.normalize("NFKC", name).lower()).replace("ー", "")
+    out = []
+    double = False
+    for i, c in enumerate(kana):
+        if c == "ッ":
+            double = True
+            continue
+        if c in _YOON and i > 0 and kana[i - 1] in _KANA_ROMAJI:
+            # キャ → kya / シャ → sya / ファ → ha（直前の母音を差し替える）
+            prev = out.pop()
+            out.append(prev[:-1] + _YOON[c])
+            continue
+        if c in _KANA_ROMAJI or c in _YOON:
+            syllable = _KANA_ROMAJI.get(c) or _YOON[c]
+        elif c.isascii() and c.isalnum():
+            syllable = c
+        elif c.isspace() or c in "・-":
+            continue
+        else:
+            return ""
+        if double and syllable[0] not in "aiueon":
+            syllable = syllable[0] + syllable
+        double = False
+        out.append(syllable)
+    return romaji_canon("".join(out))
+
+# ===========================
+# 横断検索インデックス（文字ごとのシャード）
+# ===========================
+def build_search_shards(grouped):
+    """検索キーに含まれる文字 → [[名前, 検索キー, href, サムネイル, ローマ字キー], ...]。
+
+    部分一致の結果はクエリに含まれるどの文字のシャードにも入っているので、
+    クライアントは一番小さいシャードだけ取って絞り込めばよい。並びは grouped の順。
+    """
+    shards = {}
+    for alt, srcs in grouped.items():
+        key = search_key(alt)
+        romaji = romaji_key(alt) if SEARCH_ROMAJI else ""
+        row = [alt, key, f"{safe_filename(alt)}.html", (srcs[0] if srcs else "") + "?width=300", romaji]
+        for ch in dict.fromkeys(key + romaji):
+            shards.setdefault(ch, []).append(row)
+    return shards
+
+def write_search_index(grouped):
+    """シャードを search/<コードポイント>.<hash>.json に書き、文字 → [hash, 件数] の目次を返す"""
+    os.makedirs(SEARCH_DIR, exist_ok=True)
+    manifest = {}
+    keep = set()
+    total = 0
+    for ch, rows in build_search_shards(grouped).items():
+        data = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()[:8]
+        filename = f"{ord(ch):x}.{digest}.json"
+        path = os.path.join(SEARCH_DIR, filename)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+            stage_count(files_written=1, bytes_written=len(data))
+        manifest[ch] = [digest, len(rows)]
+        keep.add(filename)
+        total += len(data)
+
+    for path in glob.glob(os.path.join(SEARCH_DIR, "*.json")):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+
+    print(f"🔍 検索インデックス: {len(manifest)} シャード / {total:,} bytes")
+    return manifest
+
 # ===========================
 # index.html を生成（最終確定版）
 # ===========================
-def generate_index(grouped, exif_cache):
+def generate_index(grouped, exif_cache, images=None):
+    images = images or {}
     index_parts = []
+    assets = page_assets()
 
     # ===========================
     # HTML 骨格（head）
@@ -2993,27 +4822,18 @@ def generate_index(grouped, exif_cache):
   📷 写真をクリックするとフルスクリーンでじっくり観察できます<br>
   ⭐ 気になった写真は★で保存して、あとで「観察ノート」で見返せます
 </p>
-{STYLE_TAG}
+{assets["style"]}
 {LIGHTGALLERY_TAGS}
 """)
 
     # --------------------------
-    # 検索用 JS データ（headに置く）
+    # 検索用インデックス（本体は search/ のシャード、head には目次だけ）
     # --------------------------
-    all_mushrooms_js = []
-
-    for alt, srcs in grouped.items():
-        thumb = srcs[0] if srcs else ""
-        all_mushrooms_js.append({
-            "name": alt,
-            "name_norm": alt.lower(),
-            "href": f"{safe_filename(alt)}.html",
-            "thumb": thumb + "?width=300"
-        })
+    search_index = {"base": "search/", "shards": write_search_index(grouped)}
 
     index_parts.append(f"""
 <script>
-window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
+window.SEARCH_INDEX = {json.dumps(search_index, ensure_ascii=False, separators=(",", ":"))};
 </script>
 </head>
 <body>
@@ -3038,7 +4858,7 @@ window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
     
       <div class="search-empty" style="display:none;">
         🔍 該当するキノコが見つかりませんでした<br>
-        <small>ひらがな・カタカナを変えて試してみてください</small>
+        <small>名前の一部や別の呼び名で試してみてください</small>
       </div>
     
       <div class="index-pagination"></div>
@@ -3110,6 +4930,7 @@ window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
                 out.append({
                     "name": n,
                     "thumb": grouped[n][0] + "?width=400",
+                    "size": size_attrs(grouped[n][0], images, 400),
                     "href": f"{safe_filename(n)}.html"
                 })
         return out
@@ -3134,7 +4955,7 @@ window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
         for it in items:
             index_parts.append(f"""
 <a class="rec-item" href="{it['href']}">
-  <img src="{it['thumb']}" alt="{it['name']}">
+  <img src="{it['thumb']}"{it['size']} alt="{it['name']}">
   <div>{it['name']}</div>
 </a>
 """)
@@ -3154,7 +4975,7 @@ window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
     # footer（JS）
     # ===========================
     index_parts.append(f"""
-{SCRIPT_TAG}
+{assets["script"]}
 </body>
 </html>
 """)
@@ -3164,14 +4985,58 @@ window.ALL_MUSHROOMS = {json.dumps(all_mushrooms_js, ensure_ascii=False)};
     # ===========================
     with open(f"{OUTPUT_DIR}/index.html", "w", encoding="utf-8") as f:
         f.write("".join(index_parts))
+    stage_count(pages_written=1, files_written=1, bytes_written=os.path.getsize(f"{OUTPUT_DIR}/index.html"))
 
     print("✅ index.html 生成完了")
 
+# ===========================
+# 観察ノート用メタデータ（写真単位のシャード）
+# ===========================
+def photo_meta_shard(src, digits=None):
+    """src の FNV-1a 32bit の先頭 digits 桁（SCRIPT_TAG の photoMetaShard と同じ）"""
+    h = 0x811C9DC5
+    for b in src.encode("utf-8"):
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    return f"{h:08x}"[:digits or META_SHARD_HEX]
+
+def write_photo_meta(grouped, exif_cache):
+    """src → [キノコ名, 撮影日] を meta/<prefix>.<hash>.json に分けて書き、目次を返す。
+
+    観察ノートは★を付けた写真のシャードだけを取得する。
+    """
+    shards = {}
+    for alt, srcs in grouped.items():
+        for src in srcs:
+            date = (exif_cache.get(src) or {}).get("date") or ""
+            shards.setdefault(photo_meta_shard(src), {})[src] = [alt, date]
+
+    os.makedirs(META_DIR, exist_ok=True)
+    manifest = {}
+    keep = set()
+    for key in sorted(shards):
+        data = json.dumps(shards[key], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()[:8]
+        filename = f"{key}.{digest}.json"
+        path = os.path.join(META_DIR, filename)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+            stage_count(files_written=1, bytes_written=len(data))
+        manifest[key] = digest
+        keep.add(filename)
+
+    for path in glob.glob(os.path.join(META_DIR, "*.json")):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+
+    return {"base": "meta/", "digits": META_SHARD_HEX, "shards": manifest}
+
 # ===========================
 # ⭐ お気に入り専用ページ生成（写真単位）
 # ===========================
-def generate_favorite_page(grouped):
+def generate_favorite_page(grouped, exif_cache=None):
     parts = []
+    assets = page_assets()
 
     parts.append("""
 <h2 class="section-title">⭐ 観察ノート</h2>
@@ -3201,49 +5066,61 @@ def generate_favorite_page(grouped):
 </div>
 """)
 
-    exif_cache = load_exif_cache()
-    
-    parts.append(f"""
-    <script>
-    window.EXIF_CACHE = {json.dumps(exif_cache, ensure_ascii=False)};
-    </script>
-    """)
+    if exif_cache is None:
+        exif_cache = load_exif_cache()
 
-    # src → alt（キノコ名）対応表
-    src_to_alt = {}
-    for alt, srcs in grouped.items():
-        for src in srcs:
-            src_to_alt[src] = alt
-    
+    # 全写真の EXIF は埋め込まず、シャードの目次だけを置く
+    meta_index = write_photo_meta(grouped, exif_cache)
     parts.append(f"""
     <script>
-    window.SRC_TO_ALT = {json.dumps(src_to_alt, ensure_ascii=False)};
+    window.PHOTO_META_INDEX = {json.dumps(meta_index, separators=(",", ":"))};
     </script>
     """)
 
-    parts.append(STYLE_TAG)
+    parts.append(assets["style"])
     parts.append(LIGHTGALLERY_TAGS)
-    parts.append(SCRIPT_TAG)
+    parts.append(assets["script"])
 
     with open(f"{OUTPUT_DIR}/favorite.html", "w", encoding="utf-8") as f:
         f.write("".join(parts))
+    stage_count(pages_written=1, files_written=1, bytes_written=os.path.getsize(f"{OUTPUT_DIR}/favorite.html"))
 
     print("⭐ favorite.html（JS描画方式）生成完了")
 
 # ===========================
 # メイン
 # ===========================
-if __name__ == "__main__":
-    fetch_hatena_articles_api()
-    entries = fetch_images()
-
-    if entries:
-        exif_cache = load_exif_cache()
-        exif_cache = build_exif_cache(entries, exif_cache)
-        save_exif_cache(exif_cache)
+def run_build():
+    """記事同期からページ生成までの全工程を回す。戻り値は抽出した画像エントリ"""
+    entries = []
+    try:
+        with build_stage("articles"):
+            fetch_hatena_articles_api()
+        with build_stage("extract"):
+            entries = fetch_images()
+
+        if entries:
+            with build_stage("images"):
+                images = load_image_records()
+                images = build_image_records(entries, images)
+                fill_placeholders(images)
+                save_image_records(images)
+                prune_thumbnails(entries, images)
+
+            exif_cache = exif_view(images)
+            with build_stage("gallery"):
+                grouped = generate_gallery(entries, exif_cache, images)
+            with build_stage("index"):
+                generate_index(grouped, exif_cache, images)
+            with build_stage("favorite"):
+                generate_favorite_page(grouped, exif_cache)
+        else:
+            print("⚠️ 画像が見つかりませんでした。")
+    finally:
+        # 途中で落ちてもそこまでの工程は残す
+        print_http_metrics()
+        write_build_report()
+    return entries
 
-        grouped = generate_gallery(entries, exif_cache)
-        generate_index(grouped, exif_cache)
-        generate_favorite_page(grouped)
-    else:
-        print("⚠️ 画像が見つかりませんでした。")
+if __name__ == "__main__":
+    run_build()